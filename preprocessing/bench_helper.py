@@ -0,0 +1,64 @@
+'''
+Micro-benchmarks for the conversion helpers.
+
+Usage: python bench_helper.py [-n 50000] [--maxlen 100]
+
+@author: hqu
+'''
+
+from __future__ import print_function
+
+import time
+import argparse
+import numpy as np
+
+from helper import pad_sequences, _pad_sequences_loop
+
+def _make_jagged(n, mean_len, max_len):
+    lengths = np.minimum(np.random.poisson(mean_len, size=n), max_len)
+    seqs = np.empty(n, dtype=object)
+    for i, l in enumerate(lengths):
+        seqs[i] = np.random.normal(size=l).astype(np.float32)
+    return seqs
+
+def _timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        res = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+def bench_pad_sequences(args):
+    seqs = _make_jagged(args.num_events, args.mean_len, 2 * args.maxlen)
+    print('pad_sequences: %d sequences, mean length %.1f, maxlen %d' % (len(seqs), args.mean_len, args.maxlen))
+    for padding in ('post', 'pre'):
+        for truncating in ('post', 'pre'):
+            kwargs = dict(maxlen=args.maxlen, dtype='float32', padding=padding, truncating=truncating, value=-1.)
+            t_loop, ref = _timeit(lambda: _pad_sequences_loop(seqs, **kwargs), args.repeat)
+            t_vec, res = _timeit(lambda: pad_sequences(seqs, **kwargs), args.repeat)
+            assert np.array_equal(ref, res), 'Results differ for padding=%s, truncating=%s' % (padding, truncating)
+            print('  padding=%-4s truncating=%-4s loop: %8.3f s  vectorized: %8.3f s  speedup: %5.1fx' %
+                  (padding, truncating, t_loop, t_vec, t_loop / t_vec))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark conversion helpers')
+    parser.add_argument('-n', '--num-events',
+        type=int, default=50000,
+        help='Number of events. Default: %(default)s'
+    )
+    parser.add_argument('--maxlen',
+        type=int, default=100,
+        help='Padded length. Default: %(default)s'
+    )
+    parser.add_argument('--mean-len',
+        type=float, default=40,
+        help='Mean length of the sequences. Default: %(default)s'
+    )
+    parser.add_argument('--repeat',
+        type=int, default=3,
+        help='Number of repetitions (the best one is reported). Default: %(default)s'
+    )
+    args = parser.parse_args()
+    bench_pad_sequences(args)
@@ -0,0 +1,137 @@
+'''
+Catalog of the converted files.
+
+The catalog (`CATALOG_FILE`, in the directory of the converted files) records
+for each file its size and modification time, the number of rows, the number of
+events of each class, the sums of the weights, and the shape and dtype of every
+dataset. The data loader uses it at startup instead of opening every file, and
+falls back to reading the files that are missing from the catalog or have been
+modified since they were indexed. The catalog is updated after the conversion
+and the global shuffle, and can be (re)built standalone:
+
+    python catalog.py /path/to/converted
+
+@author: hqu
+'''
+
+from __future__ import print_function
+
+import os
+import glob
+import json
+import logging
+import argparse
+
+import numpy as np
+import tables
+
+CATALOG_FILE = 'catalog.json'
+
+def _weight_sums(f, weight_names, chunk_rows):
+    ''' Sum of each weight column and of their product (using the precomputed product, e.g., `total_weight`, if any). '''
+    names = [w for w in weight_names if w in f.root]
+    products = [[w] for w in names] + ([names] if len(names) > 1 else [])
+    precomputed = dict((node.title, node) for node in f.root if isinstance(node, tables.Leaf) and node.title)
+    sums = {}
+    for wgt_vars in products:
+        key = ','.join(wgt_vars)
+        total = 0.
+        n = getattr(f.root, wgt_vars[0]).shape[0]
+        for start in range(0, n, chunk_rows):
+            if key in precomputed:
+                wgt = precomputed[key][start:start + chunk_rows]
+            else:
+                wgt = getattr(f.root, wgt_vars[0])[start:start + chunk_rows]
+                for w in wgt_vars[1:]:
+                    wgt = wgt * getattr(f.root, w)[start:start + chunk_rows]
+            total += np.sum(wgt, dtype=np.float64)
+        sums[key] = total
+    return sums
+
+def _class_counts(node, chunk_rows):
+    ''' Number of events of each class, from the one-hot labels (n, C) or the class indices (n,). '''
+    counts = np.zeros(0, dtype=np.int64)
+    for start in range(0, node.shape[0], chunk_rows):
+        label = node[start:start + chunk_rows]
+        c = np.sum(label, axis=0, dtype=np.int64) if label.ndim > 1 else np.bincount(label.astype(np.int64))
+        if len(c) > len(counts):
+            counts = np.append(counts, np.zeros(len(c) - len(counts), dtype=np.int64))
+        counts[:len(c)] += c
+    return [int(c) for c in counts]
+
+def index_file(filepath, label_var='label', weight_names=('weight', 'class_weight'), chunk_rows=100000):
+    ''' Catalog entry of a converted file. '''
+    st = os.stat(filepath)
+    entry = {'size': st.st_size, 'mtime': st.st_mtime, 'datasets': {}}
+    with tables.open_file(filepath) as f:
+        for node in f.walk_nodes('/', 'Leaf'):
+            entry['datasets'][node._v_pathname] = {'shape': [int(s) for s in node.shape], 'dtype': str(node.dtype)}
+        label = getattr(f.root, label_var)
+        entry['rows'] = int(label.shape[0])
+        entry['class_labels'] = label.title.split(',') if label.title else [label_var]
+        entry['class_counts'] = _class_counts(label, chunk_rows)
+        entry['weight_sums'] = _weight_sums(f, weight_names, chunk_rows)
+    return entry
+
+def is_fresh(entry, filepath):
+    ''' Check if a catalog entry still describes the file. '''
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return False
+    return entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime
+
+def load_catalog(dirpath):
+    try:
+        with open(os.path.join(dirpath, CATALOG_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {'files': {}}
+
+def update_catalog(dirpath, pattern='*.h5', label_var='label', weight_names=('weight', 'class_weight')):
+    ''' Index the files in `dirpath` that are missing from the catalog or stale, and drop the removed ones. '''
+    catalog = load_catalog(dirpath)
+    files = {}
+    n_indexed = 0
+    for filepath in sorted(glob.glob(os.path.join(dirpath, pattern))):
+        name = os.path.basename(filepath)
+        entry = catalog['files'].get(name)
+        if not is_fresh(entry, filepath):
+            try:
+                entry = index_file(filepath, label_var, weight_names)
+            except Exception as e:
+                logging.warning('Cannot index %s: %s' % (filepath, str(e)))
+                continue
+            n_indexed += 1
+        files[name] = entry
+    catalog['files'] = files
+    tmpfile = os.path.join(dirpath, CATALOG_FILE + '.tmp')
+    with open(tmpfile, 'w') as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    os.rename(tmpfile, os.path.join(dirpath, CATALOG_FILE))
+    logging.info('Catalog of %s updated: %d files, %d (re)indexed' % (dirpath, len(files), n_indexed))
+    return catalog
+
+def main():
+    parser = argparse.ArgumentParser('Index the converted files')
+    parser.add_argument('dirpath',
+        help='Directory of the converted files.'
+    )
+    parser.add_argument('--pattern',
+        default='*.h5',
+        help='Pattern of the files to index. Default: %(default)s'
+    )
+    parser.add_argument('--label-var',
+        default='label',
+        help='Name of the label dataset. Default: %(default)s'
+    )
+    parser.add_argument('--weight-names',
+        default='weight,class_weight',
+        help='Weight datasets whose sums (and the sum of their product) are recorded. Default: %(default)s'
+    )
+    args = parser.parse_args()
+    update_catalog(args.dirpath, args.pattern, args.label_var, args.weight_names.replace(' ', '').split(','))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(levelname)s: %(message)s')
+    main()
@@ -6,59 +6,366 @@ Convert root files to pyTables.
 
 from __future__ import print_function
 
+__version__ = '1.2'  # to be increased when the content of the output files changes
+
 import os
+import re
 import traceback
 import time
 import argparse
 import numpy as np
 import numexpr as ne
 import math
+import functools
 
 import logging
-from helper import xrd, pad_sequences
+from helper import xrd, flatten_jagged, pad_jagged, fill_images, sparse_images, get_selected_entries, read_entries, \
+    set_staging, prefetch, invalidate
+from staging import StagingCache
+from selection_index import SELECTION_INDEX_FILE
+from planner import load_plan
+from manifest import job_key, is_complete, write_manifest
 
 import tables
 filters = tables.Filters(complevel=7, complib='blosc')
 tables.set_blosc_max_threads(6)
 
 def _write_carray(a, h5file, name, group_path='/', **kwargs):
-    h5file.create_carray(group_path, name, obj=a, filters=filters, createparents=True, **kwargs)
-
-def _make_labels(md, rec, h5file, name='label'):
-    label = np.stack([rec[v] for v in md.label_branches], axis=1)
-    _write_carray(label, h5file, name=name, title=','.join(md.label_branches))
-
-def _make_weight(md, rec, h5file, name='weight'):
-    wgt = np.ones(rec.shape[0], dtype=np.float32)
-    if md.reweight_method == 'none':
-        pass
+    return h5file.create_carray(group_path, name, obj=a, filters=filters, createparents=True, **kwargs)
+
+def _append_earray(a, h5file, name, group_path='/', expectedrows=50000, **kwargs):
+    ''' Append to an extendable array, creating it at the first call. '''
+    try:
+        arr = h5file.get_node(group_path, name)
+    except tables.NoSuchNodeError:
+        arr = h5file.create_earray(group_path, name, atom=tables.Atom.from_dtype(a.dtype), shape=(0,) + a.shape[1:],
+                                   filters=filters, expectedrows=expectedrows, createparents=True, **kwargs)
+    arr.append(a)
+    return arr
+
+def _write_array(a, h5file, name, append=False, attrs=None, **kwargs):
+    if append:
+        arr = _append_earray(a, h5file, name, **kwargs)
     else:
-        for label in md.reweight_classes:
-            info = md.reweight_info[label]
-            loc = rec[label] == 1
-            rwgt_x_vals = rec[md.reweight_var[0]][loc]
-            rwgt_y_vals = rec[md.reweight_var[1]][loc]
-            x_indices = np.clip(np.digitize(rwgt_x_vals, info['x_edges']) - 1, a_min=0, a_max=len(info['x_edges']) - 2)
-            y_indices = np.clip(np.digitize(rwgt_y_vals, info['y_edges']) - 1, a_min=0, a_max=len(info['y_edges']) - 2)
-            wgt[loc] = np.asarray(info['hist'])[x_indices, y_indices]
-    _write_carray(wgt, h5file, name)
-
-def _make_class_weight(md, rec, h5file, name='class_weight'):
-    wgt = np.ones(rec.shape[0], dtype=np.float32)
+        arr = _write_carray(a, h5file, name, **kwargs)
+    if attrs:
+        for k in attrs:
+            arr.attrs[k] = attrs[k]
+
+def _column(rec, var, perm=None):
+    ''' Get a column of the record array, reordered by the permutation `perm` if given. '''
+    return rec[var] if perm is None else rec[var][perm]
+
+def _make_labels(md, rec, h5file, name='label', append=False, perm=None):
+    label = np.stack([_column(rec, v, perm) for v in md.label_branches], axis=1)
+    _write_array(label, h5file, name=name, append=append, title=','.join(md.label_branches))
+
+def _weight_table(md):
+    ''' Stacked reweighting histograms (n_classes+1, nx, ny) and class weights (n_classes+1,) built once from
+        `md.reweight_info`. The last slot is for events not in any of the reweighting classes (weight 1). '''
+    if getattr(md, '_weight_table', None) is None:
+        infos = [md.reweight_info[label] for label in md.reweight_classes]
+        x_edges = np.asarray(infos[0]['x_edges'])
+        y_edges = np.asarray(infos[0]['y_edges'])
+        table = np.ones((len(infos) + 1, len(x_edges) - 1, len(y_edges) - 1), dtype=np.float32)
+        table[:-1] = [info['hist'] for info in infos]
+        class_wgt = np.ones(len(infos) + 1, dtype=np.float32)
+        class_wgt[:-1] = [info['class_wgt'] for info in infos]
+        md._weight_table = (x_edges, y_edges, table, class_wgt)
+    return md._weight_table
+
+def _make_weights(md, rec, h5file, append=False, perm=None, total_weight=False):
+    ''' Write the `weight` and `class_weight` columns, and their product as `total_weight` if requested. '''
     if md.reweight_method == 'none':
-        pass
+        wgt = np.ones(rec.shape[0], dtype=np.float32)
+        class_wgt = np.ones(rec.shape[0], dtype=np.float32)
     else:
-        for label in md.reweight_classes:
-            loc = rec[label][:] == 1
-            wgt[loc] = md.reweight_info[label]['class_wgt']
-    _write_carray(wgt, h5file, name)
-
-def _transform_var(md, rec, h5file, cols, no_transform=False, pad_method='zero'):
+        x_edges, y_edges, table, class_table = _weight_table(md)
+        # class index of each event (the last matching class wins), n_classes if none
+        cls = np.full(rec.shape[0], len(md.reweight_classes), dtype=np.intp)
+        for i, label in enumerate(md.reweight_classes):
+            cls[rec[label] == 1] = i
+        x_indices = np.clip(np.digitize(rec[md.reweight_var[0]], x_edges) - 1, a_min=0, a_max=len(x_edges) - 2)
+        y_indices = np.clip(np.digitize(rec[md.reweight_var[1]], y_edges) - 1, a_min=0, a_max=len(y_edges) - 2)
+        wgt = table.ravel()[np.ravel_multi_index((cls, x_indices, y_indices), table.shape)]
+        class_wgt = class_table[cls]
+    if perm is not None:
+        wgt = wgt[perm]
+        class_wgt = class_wgt[perm]
+    _write_array(wgt, h5file, 'weight', append=append)
+    _write_array(class_wgt, h5file, 'class_weight', append=append)
+    if total_weight:
+        _write_array(wgt * class_wgt, h5file, 'total_weight', append=append, title='weight,class_weight')
+
+def _standardize(a, median, scale, clip_range=None):
+    ''' Fused NaN/inf replacement (as np.nan_to_num), standardization (a-median)/scale
+        and optional clipping, in a single in-place pass over the float array `a`. '''
+    zero = a.dtype.type(0)
+    fmax = a.dtype.type(np.finfo(a.dtype).max)
+    expr = '((where(a != a, zero, where(a > fmax, fmax, where(a < -fmax, -fmax, a))) - median) / scale)'
+    if clip_range is not None:
+        lo, hi = a.dtype.type(clip_range[0]), a.dtype.type(clip_range[1])
+        expr = 'where({t} < lo, lo, where({t} > hi, hi, {t}))'.format(t=expr)
+    ne.evaluate(expr, out=a)
+    return a
+
+def _storage_type(md, var):
+    ''' Storage type of a variable: the type of the first pattern in `md.storage_types` matching it, or None. '''
+    for regex, spec in md.storage_types or []:
+        if re.match(regex, var):
+            return spec
+    return None
+
+def _compact(a, spec, median=0., scale=1.):
+    ''' Convert `a` to the storage type `spec`, returning the stored array and the attributes needed to widen it back:
+         - a float type (e.g., 'float16'): cast, saturating at the largest finite value;
+         - an integer type (e.g., 'uint8', 'int8'): exact storage of the input values, i.e., a*scale+median for a
+           transformed variable, with the transformation stored as q_scale and q_offset. Returns None if the values
+           are not integers within the range of the type (or cannot be recovered to float32 precision);
+         - [integer type, q_scale, q_offset]: quantization a ~= stored*q_scale+q_offset, saturating at the range of the type.
+        The data loader widens the stored values with `stored.astype(orig_dtype) * q_scale + q_offset`. '''
+    attrs = {'orig_dtype': str(a.dtype)}
+    if isinstance(spec, (list, tuple)):
+        dtype = np.dtype(spec[0])
+        q_scale, q_offset = np.float32(spec[1]), np.float32(spec[2] if len(spec) > 2 else 0)
+        limits = np.iinfo(dtype)
+        q = np.rint((a - q_offset) / q_scale)
+        n_saturated = np.count_nonzero((q < limits.min) | (q > limits.max))
+        if n_saturated:
+            logging.warning('%d values saturated when quantizing to %s' % (n_saturated, dtype))
+        attrs.update(q_scale=q_scale, q_offset=q_offset)
+        return np.clip(q, limits.min, limits.max).astype(dtype), attrs
+    dtype = np.dtype(spec)
+    if dtype.kind == 'f':
+        fmax = np.finfo(dtype).max
+        return np.clip(a, -fmax, fmax).astype(dtype), attrs
+    limits = np.iinfo(dtype)
+    transformed = median != 0 or scale != 1
+    q_scale, q_offset = (np.float32(1. / scale), np.float32(-median / scale)) if transformed else (1, 0)
+    q = np.rint(a * np.float64(scale) + median) if transformed else a
+    if np.any(q < limits.min) or np.any(q > limits.max):
+        return None
+    stored = q.astype(dtype)
+    if transformed:
+        if not np.allclose(stored.astype(a.dtype) * q_scale + q_offset, a, rtol=1e-5, atol=1e-6):
+            return None
+        attrs.update(q_scale=q_scale, q_offset=q_offset)
+    elif not np.array_equal(stored, a):
+        return None
+    return stored, attrs
+
+def _without_clip(attrs):
+    # the quantized values are not guaranteed to be within the clip range
+    return dict((k, v) for k, v in (attrs or {}).items() if k not in ('clip_min', 'clip_max'))
+
+def _write_var(md, a, h5file, var, name, append=False, attrs=None, median=0., scale=1.):
+    ''' Write a variable with the storage type configured in `md.storage_types`. '''
+    spec = _storage_type(md, var)
+    if spec is None:
+        return _write_array(a, h5file, name=name, append=append, attrs=attrs)
+    existing = h5file.get_node('/', name).dtype if append and name in h5file.root else None
+    result = _compact(a, spec, median, scale)
+    if result is None:
+        if existing is not None and existing.kind in 'iu':
+            raise ValueError('Variable %s cannot be stored exactly as %s' % (var, spec))
+        logging.warning('Variable %s cannot be stored exactly as %s, keeping %s' % (var, spec, a.dtype))
+    elif existing is None or existing == result[0].dtype:
+        a = result[0]
+        if isinstance(spec, (list, tuple)):
+            attrs = _without_clip(attrs)
+        attrs = dict(attrs or {}, **result[1])
+    _write_array(a, h5file, name=name, append=append, attrs=attrs)
+
+def group_channels(md):
+    ''' Transformed variables of each variable group {group: [var]}, in the order of `md.var_branches`. '''
+    channels = {}
+    for var in md.var_branches:
+        for v_group in md.var_groups:
+            if any(re.match(regex, var) for regex in md.var_groups[v_group][0]):
+                channels.setdefault(v_group, []).append(str(var))
+                break
+    return channels
+
+def _sort_spec(md, v_group):
+    ''' Sorting of the sequence variables of a group at conversion ({'var': key branch, 'descend': bool}), or None. '''
+    sort_by = getattr(md, 'sort_by', None)
+    return sort_by.get(v_group) if sort_by else None
+
+def _sort_keys(md, cols):
+    ''' Key branches needed to sort the variables `cols`. '''
+    keys = set()
+    for v_group, channels in group_channels(md).items():
+        spec = _sort_spec(md, v_group)
+        if spec and any(v in cols for v in channels):
+            keys.add(str(spec['var']))
+    return list(keys)
+
+def _sort_order(md, rec, v_group, perm=None):
+    ''' Reordering of the flat values of the sequence variables of a group: the first `size` elements of each row (those
+        kept after truncation) are sorted by the key, the others are left in place. Ties keep the original order.
+        Returns the index into the flat values, and the row offsets the variables must have. '''
+    spec = _sort_spec(md, v_group)
+    key, offsets = flatten_jagged(_column(rec, spec['var'], perm))
+    size = md.branches_info[group_channels(md)[v_group][0]]['size']
+    kept = np.minimum(np.diff(offsets), size)
+    rows = np.repeat(np.arange(len(kept)), kept)
+    pos = np.arange(len(rows)) - np.repeat(np.cumsum(kept) - kept, kept)  # position in the row
+    flat = offsets[rows] + pos
+    key = key[flat].astype(np.float64)
+    order = np.arange(offsets[-1])
+    order[flat] = flat[np.lexsort((-key if spec['descend'] else key, rows))]
+    return order, offsets
+
+def _sort_attrs(md, v_group):
+    spec = _sort_spec(md, v_group)
+    return {'sorted_by': str(spec['var']), 'sort_descend': bool(spec['descend'])}
+
+_mixed_groups = set()  # groups whose mixed storage types have been reported
+
+def _group_storage_type(md, name, channels):
+    ''' Storage type of a group: the type of its channels if they all have the same one. Channels with different float
+        or 8-bit integer types (e.g., flags, exact in float16) share the widest of the float types (at least float16).
+        Otherwise (e.g., a channel without storage type or quantized) the group is kept as float32, i.e., None. '''
+    specs = [_storage_type(md, v) for v in channels]
+    if all(sp == specs[0] for sp in specs):
+        return specs[0]
+    dtypes = [None if sp is None or isinstance(sp, (list, tuple)) else np.dtype(sp) for sp in specs]
+    if all(dt is not None and (dt.kind == 'f' or (dt.kind in 'iu' and dt.itemsize == 1)) for dt in dtypes):
+        return str(max([dt for dt in dtypes if dt.kind == 'f'] + [np.dtype('float16')], key=lambda dt: dt.itemsize))
+    if name not in _mixed_groups:
+        _mixed_groups.add(name)
+        conflicts = sorted(set(str(sp) for sp in specs))
+        logging.warning('Group %s has channels with storage types %s, keeping float32' % (name, ', '.join(conflicts)))
+    return None
+
+def _compact_channels(md, name, channels, block_vars, block, transforms, node=None, attrs=None):
+    ''' Convert the channels `block_vars` (axis 1 of `block`) to the storage type of the group `channels` (see
+        `_group_storage_type`); with mixed types, each channel is first converted to its own type (keeping the exact
+        storage of the integer ones). Returns the stored array, the attributes, and the per-channel widening factors
+        (q_scale, q_offset) or None. '''
+    spec = _group_storage_type(md, name, channels)
+    if spec is None:
+        return block, attrs, None, None
+    specs = [_storage_type(md, v) for v in block_vars]
+    mixed = any(sp != spec for sp in specs)
+    results = [_compact(block[:, i], specs[i] if mixed else spec, *transforms[i]) for i in range(block.shape[1])]
+    if any(res is None for res in results):
+        if node is not None and node.dtype.kind in 'iu':
+            raise ValueError('Group %s cannot be stored exactly as %s' % (name, spec))
+        logging.warning('Group %s cannot be stored exactly as %s, keeping %s' % (name, spec, block.dtype))
+        return block, attrs, None, None
+    if mixed:
+        results = [(res[0].astype(spec), res[1]) for res in results]
+    if node is not None and node.dtype != results[0][0].dtype:
+        return block, attrs, None, None
+    stored = np.stack([res[0] for res in results], axis=1)
+    q_scale = np.array([res[1].get('q_scale', 1) for res in results], dtype=np.float32)
+    q_offset = np.array([res[1].get('q_offset', 0) for res in results], dtype=np.float32)
+    if isinstance(spec, (list, tuple)):
+        attrs = _without_clip(attrs)
+    return stored, dict(attrs or {}, orig_dtype=str(block.dtype)), q_scale, q_offset
+
+def _set_channel_attrs(node, n_channels, c0, q_scale, q_offset, attrs):
+    if q_scale is not None:
+        # per-channel widening factors, filled block by block
+        for key, values, default in (('q_scale', q_scale, 1), ('q_offset', q_offset, 0)):
+            full = node.attrs[key] if key in node.attrs else np.full(n_channels, default, dtype=np.float32)
+            full[c0:c0 + len(values)] = values
+            node.attrs[key] = full
+    for k in attrs or {}:
+        node.attrs[k] = attrs[k]
+
+def _write_group(md, h5file, v_group, channels, block_vars, block, transforms, append=False, attrs=None):
+    ''' Write the channels `block_vars` (a contiguous range of `channels`) of a group to the (n, C, W) dataset
+        `group_<v_group>`, created at the first call; the channel names are stored in its title.
+        The storage type of the group is given by `_group_storage_type`. '''
+    name = 'group_%s' % v_group
+    c0 = channels.index(block_vars[0])
+    c1 = c0 + len(block_vars)
+    if channels[c0:c1] != block_vars:
+        raise ValueError('Variables %s are not contiguous channels of group %s' % (','.join(block_vars), v_group))
+    node = h5file.get_node('/', name) if name in h5file.root else None
+    stored, attrs, q_scale, q_offset = _compact_channels(md, v_group, channels, block_vars, block, transforms, node, attrs)
+    title = ','.join(channels)
+    if append:
+        node = _append_earray(stored, h5file, name, title=title)
+    else:
+        if node is None:
+            node = h5file.create_carray('/', name, atom=tables.Atom.from_dtype(stored.dtype), title=title,
+                                        shape=(stored.shape[0], len(channels)) + stored.shape[2:], filters=filters)
+        node[:, c0:c1] = stored
+    _set_channel_attrs(node, len(channels), c0, q_scale, q_offset, attrs)
+
+def _write_ragged(md, h5file, v_group, channels, parts, append=False, attrs=None):
+    ''' Write the sequence variables of a group without padding: flat values (C, N) in `ragged_<v_group>`, and the
+        start of each row in `ragged_<v_group>_offsets` (n,). A row keeps the first `size` elements of each variable, and
+        its length is the largest among the variables, the shorter ones being filled with their pad value. The width
+        `size` and the pad values are stored as attributes, for the data loader to rebuild the dense (n, C, W) array.
+        `parts` is {var: (values, offsets, pad_value, median, scale)} of the transformed variables. '''
+    name = 'ragged_%s' % v_group
+    if any(v not in parts for v in channels):
+        raise ValueError('All the variables of group %s are needed for the ragged format' % v_group)
+    width = md.branches_info[channels[0]]['size']
+    kept = [np.minimum(np.diff(parts[v][1]), width) for v in channels]
+    lengths = np.max(kept, axis=0)
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    pad_values = np.array([parts[v][2] for v in channels], dtype=np.float32)
+    block = np.empty((int(lengths.sum()), len(channels)), dtype=np.float32)
+    block[:] = pad_values
+    for c, v in enumerate(channels):
+        values, offsets = parts[v][0], parts[v][1]
+        rows = np.repeat(np.arange(len(lengths)), kept[c])
+        pos = np.arange(len(rows)) - np.repeat(np.cumsum(kept[c]) - kept[c], kept[c])  # position in the row
+        block[starts[rows] + pos, c] = values[offsets[rows] + pos]
+    node = h5file.get_node('/', name) if name in h5file.root else None
+    stored, attrs, q_scale, q_offset = _compact_channels(md, v_group, channels, channels, block, [parts[v][3:] for v in channels], node, attrs)
+    if node is None:
+        # channel-major, so that the values of each channel are compressed together
+        node = h5file.create_earray('/', name, atom=tables.Atom.from_dtype(stored.dtype), shape=(len(channels), 0),
+                                    title=','.join(channels), filters=filters, expectedrows=max(block.shape[0], 100000))
+    base = node.shape[1]
+    node.append(stored.T)
+    _append_earray(starts + base, h5file, name + '_offsets')
+    _set_channel_attrs(node, len(channels), 0, q_scale, q_offset, dict(attrs or {}, width=width, pad_values=pad_values))
+
+def _transform_var(md, rec, h5file, cols, no_transform=False, pad_method='zero', append=False, perm=None, group_vars=False, ragged=False):
+    ''' Transform and write the variables `cols`. With `group_vars`, the variables of each variable group
+        are written together as the channels of a single dataset (see `_write_group`). With `ragged`, the
+        sequence variables are written without padding (see `_write_ragged`). The sequence variables of the groups in
+        `md.sort_by` are sorted by the key of the group (see `_sort_order`) and tagged with the `sorted_by` and
+        `sort_descend` attributes. '''
+    buffers = {}  # reuse the padded output buffers between variables of the same size
+    clip_range = md.clip_range
+    attrs = {'clip_min': clip_range[0], 'clip_max': clip_range[1]} if clip_range is not None else None
+    groups = group_channels(md) if (group_vars or ragged) and not no_transform else {}
+    blocks = {}  # {v_group: (block_vars, block, transforms)}
+    parts = {}  # {v_group: {var: (values, offsets, pad_value, median, scale)}} of the ragged groups
+    for v_group, channels in groups.items():
+        block_vars = [v for v in channels if v in cols]
+        size = md.branches_info[channels[0]]['size']
+        if ragged and size and size > 1:
+            if block_vars:
+                parts[v_group] = {}
+        elif block_vars and group_vars:
+            shape = (len(rec), len(block_vars)) + ((size,) if size and size > 1 else ())
+            blocks[v_group] = (block_vars, np.empty(shape, dtype=np.float32), [None] * len(block_vars))
+    var_group = dict((v, g) for g in blocks for v in blocks[g][0])
+    ragged_group = dict((v, g) for g in parts for v in groups[g])
+    sort_group = {}  # {var: v_group} of the sequence variables to be sorted
+    if not no_transform:
+        for v_group, channels in group_channels(md).items():
+            size = md.branches_info[channels[0]]['size']
+            if _sort_spec(md, v_group) and size and size > 1:
+                sort_group.update((v, v_group) for v in channels)
+    orders = {}  # {v_group: (order, offsets)}
+    def _attrs(v_group):
+        return dict(attrs or {}, **_sort_attrs(md, v_group)) if v_group in orders else attrs
     for var in cols:
         var = str(var)  # get rid of unicode
         if no_transform:
             logging.debug('Writing variable orig_%s without transformation' % var)
-            _write_carray(rec[var], h5file, name='orig_%s' % var)
+            _write_var(md, _column(rec, var, perm), h5file, var, name='orig_%s' % var, append=append)
             continue
         logging.debug('Transforming variable %s' % var)
         info = md.branches_info[var]
@@ -67,7 +374,7 @@ def _transform_var(md, rec, h5file, cols, no_transform=False, pad_method='zero')
         if scale == 0:
             scale = 1
         if info['size'] and info['size'] > 1:
-            # for sequence-like vars, perform padding first
+            # for sequence-like vars, transform the flat values, then pad directly into the output buffer
             if pad_method == 'min':
                 pad_value = info['min'] - scale  # ->min-1 ## FIXME: which is the better padding value
             elif pad_method == 'max':
@@ -76,192 +383,472 @@ def _transform_var(md, rec, h5file, cols, no_transform=False, pad_method='zero')
                 pad_value = info['median']  # ->0 ## FIXME: which is the better padding value
             else:
                 raise NotImplemented('pad_method %s is not supported' % pad_method)
-            a = pad_sequences(rec[var], maxlen=info['size'], dtype='float32', padding='post', truncating='post', value=pad_value)
-            a = np.nan_to_num(a)  # FIXME: protect against NaN
+            values, offsets = flatten_jagged(_column(rec, var, perm))
+            if var in sort_group:
+                v_group = sort_group[var]
+                if v_group not in orders:
+                    orders[v_group] = _sort_order(md, rec, v_group, perm)
+                order, key_offsets = orders[v_group]
+                if not np.array_equal(offsets, key_offsets):
+                    raise ValueError('Variable %s does not have the same lengths as the sorting key of group %s' % (var, v_group))
+                values = values[order]
+            values = _standardize(values.astype(np.float32), median, scale, clip_range)
+            pad_value = _standardize(np.array([pad_value], dtype=np.float32), median, scale, clip_range)[0]
+            if var in ragged_group:
+                parts[ragged_group[var]][var] = (values, offsets, pad_value, median, scale)
+                continue
+            shape = (len(offsets) - 1, info['size'])
+            if var in var_group:
+                # pad directly into the channel of the group
+                block_vars, block, _ = blocks[var_group[var]]
+                out = block[:, block_vars.index(var)]
+            else:
+                if shape not in buffers:
+                    buffers[shape] = np.empty(shape, dtype=np.float32)
+                out = buffers[shape]
+            a = pad_jagged(values, offsets, maxlen=info['size'], dtype='float32', padding='post', truncating='post', value=pad_value, out=out)
         else:
-            a = rec[var].copy()  # need to copy, otherwise modifying the original array
-            a = np.nan_to_num(a)  # FIXME: protect against NaN
-        ne.evaluate('(a-median)/scale', out=a)
-        _write_carray(a, h5file, name=var)
+            a = rec[var].copy() if perm is None else rec[var][perm]  # need to copy, otherwise modifying the original array
+            if a.dtype.kind != 'f':
+                a = a.astype(np.float32)
+            a = _standardize(a, median, scale, clip_range)
+            if var in var_group:
+                block_vars, block, _ = blocks[var_group[var]]
+                block[:, block_vars.index(var)] = a
+        if var in var_group:
+            block_vars, _, transforms = blocks[var_group[var]]
+            transforms[block_vars.index(var)] = (median, scale)
+            continue
+        _write_var(md, a, h5file, var, name=var, append=append, attrs=_attrs(sort_group.get(var)), median=median, scale=scale)
+    for v_group in blocks:
+        block_vars, block, transforms = blocks[v_group]
+        _write_group(md, h5file, v_group, groups[v_group], block_vars, block, transforms, append=append, attrs=_attrs(v_group))
+    for v_group in parts:
+        _write_ragged(md, h5file, v_group, groups[v_group], parts[v_group], append=append, attrs=_attrs(v_group))
 
 def _make_var(md, ct):
     pass
 
-def _make_image(md, rec, h5file, output='img'):
+def _make_image(md, rec, h5file, output='img', chunk_size=2000, append=False, perm=None, image_format='dense'):
+    ''' Write the jet images of the events, as:
+         - 'dense': (n, n_pixels, n_pixels) images in `<output>`;
+         - 'pixels': the flat index and intensity of the non-empty pixels in `<output>_pixels` and `<output>_values`;
+         - 'particles': the (x, y, weight) of the particles in `<output>_particles` (3, N), to be binned by the data
+           loader at the requested resolution.
+        For the sparse formats, the start of each event is stored in `<output>_offsets`. '''
     wgt = rec[md.var_img]
     x = rec[md.var_pos[0]]
     y = rec[md.var_pos[1]]
-    img = np.zeros(shape=(len(wgt), md.n_pixels, md.n_pixels))
-    for i in range(len(wgt)):
-        hist2d, xedges, yedges = np.histogram2d(x[i], y[i], bins=[md.n_pixels, md.n_pixels], range=md.img_ranges, weights=wgt[i])
-        img[i] = hist2d
-    _write_carray(img, h5file, name=output)
+    n = len(wgt)
+    if image_format != 'dense':
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            idx = slice(start, stop) if perm is None else perm[start:stop]
+            if image_format == 'pixels':
+                pixels, values, lengths = sparse_images(x[idx], y[idx], wgt[idx], md.n_pixels, md.img_ranges)
+                base = h5file.get_node('/', output + '_pixels').shape[0] if output + '_pixels' in h5file.root else 0
+                node = _append_earray(pixels, h5file, output + '_pixels', expectedrows=100000)
+                _append_earray(values, h5file, output + '_values', expectedrows=100000)
+            else:
+                values, offsets = flatten_jagged(wgt[idx])
+                particles = np.stack([flatten_jagged(x[idx])[0], flatten_jagged(y[idx])[0], values]).astype(np.float32)
+                lengths = np.diff(offsets)
+                if output + '_particles' in h5file.root:
+                    node = h5file.get_node('/', output + '_particles')
+                else:
+                    # channel-major, so that x, y and the weights are compressed separately
+                    node = h5file.create_earray('/', output + '_particles', atom=tables.Float32Atom(), shape=(3, 0),
+                                                title='x,y,weight', filters=filters, expectedrows=100000)
+                base = node.shape[1]
+                node.append(particles)
+            starts = np.zeros(len(lengths), dtype=np.int64)
+            np.cumsum(lengths[:-1], out=starts[1:])
+            _append_earray(starts + base, h5file, output + '_offsets')
+            node.attrs['n_pixels'] = md.n_pixels
+            node.attrs['img_ranges'] = np.array(md.img_ranges, dtype=np.float64)
+        return
+    if not append:
+        img = h5file.create_carray('/', output, atom=tables.Float32Atom(), shape=(n, md.n_pixels, md.n_pixels), filters=filters)
+    buf = np.empty((min(n, chunk_size), md.n_pixels, md.n_pixels), dtype=np.float32)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        idx = slice(start, stop) if perm is None else perm[start:stop]
+        fill_images(x[idx], y[idx], wgt[idx], md.n_pixels, md.img_ranges, out=buf[:stop - start])
+        if append:
+            _append_earray(buf[:stop - start], h5file, output)
+        else:
+            img[start:stop] = buf[:stop - start]
+
+def _retry(func, filepath, *args):
+    ''' Call `func(filepath, *args)`, retrying on errors. `filepath` must be the path actually read (e.g., the xrootd
+        url in batch mode), so that its staged copy is dropped and fetched again after an error. '''
+    for trial in range(5):
+        try:
+            return func(filepath, *args)
+        except:
+            logging.error('Error reading %s:\n%s' % (filepath, traceback.format_exc()))
+            invalidate(filepath)  # the staged copy may be corrupt: fetch it again
+            time.sleep(min(5 * 2 ** trial, 60))
+    raise RuntimeError('Cannot read file %s' % filepath)
+
+def output_name(jobid, test_sample=False):
+    return '{type}_file_{jobid}.h5'.format(type='test' if test_sample else 'train', jobid=jobid)
+
+def output_options(total_weight=False, group_vars=False, ragged=False, image_format='dense'):
+    ''' Writer options changing the content of the output files (only the non-default ones besides `total_weight`). '''
+    options = {'total_weight': total_weight}
+    if group_vars:
+        options['group_vars'] = True
+    if ragged:
+        options['ragged'] = True
+    if image_format != 'dense':
+        options['image_format'] = image_format
+    return options
+
+def output_key(md, jobid, events, test_sample, plan, options):
+    ''' Key of the job for the completion manifest. '''
+    return job_key(md, jobid, events, test_sample, plan, __version__, options)
+
+def _job_ranges(md, jobid, events, plan=None):
+    ''' Returns a list of (filename, start, stop): the range of the selected (or raw) entries of each input file
+        assigned to the job. If a job plan is given, the job reads the ranges of selected entries assigned to it.
+        Otherwise, if the number of selected events per file is known, each job takes the same fraction of the selected
+        entries of every file, or else the same fraction of the raw entries. '''
+    if plan is not None:
+        return [tuple(r) for r in plan['jobs'][jobid]] if jobid < len(plan['jobs']) else []
+    counts = md.num_selected if md.num_selected is not None else md.num_events
+    frac = float(events) / sum(counts)
+    ranges = []
+    for fn, n in zip(md.inputfiles, counts):
+        step = int(math.ceil(frac * n))
+        start = step * jobid
+        stop = min(start + step, n)
+        if start < n:
+            ranges.append((fn, start, stop))
+    return ranges
+
+def _job_entries(md, jobid, events, batch_mode=False, plan=None):
+    ''' Returns a list of (filepath, entries) to be converted by the job (see `_job_ranges`). The selected entries are
+        read from the selection index if the number of selected events per file is known (always with a plan), or else
+        the selection is evaluated on the range of raw entries. The input files of the job and of the next one are
+        staged in the background. '''
+    ranges = _job_ranges(md, jobid, events, plan)
+    _path = lambda fn: xrd(fn) if batch_mode else fn
+    prefetch([_path(fn) for fn, _, _ in ranges], upcoming=[_path(fn) for fn, _, _ in _job_ranges(md, jobid + 1, events, plan)])
+    num_events = dict(zip(md.inputfiles, md.num_events))
+    use_index = plan is not None or md.num_selected is not None
+    file_entries = []
+    for fn, start, stop in ranges:
+        filepath = _path(fn)
+        if use_index:
+            entries = _retry(functools.partial(md.selectedEntries, fn, num_events[fn]), filepath)[start:stop]
+        else:
+            entries = _retry(get_selected_entries, filepath, md.treename, md.selection, start, stop)
+        file_entries.append((filepath, entries))
+    return file_entries
 
-def writeData(md, outputdir, jobid, batch_mode=False, test_sample=False, events=200000, dryrun=False):
+def writeData(md, outputdir, jobid, batch_mode=False, test_sample=False, events=200000, dryrun=False, plan=None, total_weight=False, group_vars=False, ragged=False, image_format='dense'):
     ''' Convert input files to a HDF file. '''
-    from root_numpy import root2array
 
     def _write(rec, output):
         logging.debug(log_prefix + 'Start making output file')
         with tables.open_file(output, mode='w') as h5file:
-            _make_labels(md, rec, h5file)
+            _make_labels(md, rec, h5file, perm=perm)
             logging.debug(log_prefix + 'Start producing weights')
-            _make_weight(md, rec, h5file)
-            _make_class_weight(md, rec, h5file)
+            _make_weights(md, rec, h5file, perm=perm, total_weight=total_weight)
             logging.debug(log_prefix + 'Start transforming variables')
-            _transform_var(md, rec, h5file, md.var_no_transform_branches, no_transform=True)
-            _transform_var(md, rec, h5file, md.var_branches)
+            _transform_var(md, rec, h5file, md.var_no_transform_branches, no_transform=True, perm=perm)
+            _transform_var(md, rec, h5file, md.var_branches, perm=perm, group_vars=group_vars, ragged=ragged)
             if md.var_img:
                 logging.debug(log_prefix + 'Start making images')
-                _make_image(md, rec, h5file, output='img')
+                _make_image(md, rec, h5file, output='img', perm=perm, image_format=image_format)
 
     log_prefix = '[%d] ' % jobid
-    outname = '{type}_file_{jobid}.h5'.format(type='test' if test_sample else 'train', jobid=jobid)
+    outname = output_name(jobid, test_sample)
     output = os.path.join(outputdir, outname)
-    if os.path.exists(output) and os.path.getsize(output) > 100 * 1024 * 1024:
-        # ignore if > 100M
-        logging.info(log_prefix + 'File %s already exist! Skipping.' % output)
+    key = output_key(md, jobid, events, test_sample, plan, output_options(total_weight, group_vars, ragged, image_format))
+    if is_complete(output, key):
+        logging.info(log_prefix + 'File %s already complete! Skipping.' % output)
         return
 
-    frac = float(events) / sum(md.num_events)
     use_branches = set(md.var_branches + md.var_no_transform_branches + md.label_branches + md.reweight_classes + md.reweight_var)
+    use_branches |= set(_sort_keys(md, md.var_branches))
     if md.var_img:
         use_branches |= set([md.var_img] + md.var_pos)
-#     use_branches = [str(var) for var in use_branches]
+    use_branches = list(use_branches)
     logging.debug(log_prefix + 'Start loading from root files')
 
     pieces = []
-    for fn, n in zip(md.inputfiles, md.num_events):
-        step = int(math.ceil(frac * n))
-        start = step * jobid
-        stop = start + step
-        if start >= n:
-            continue
-        filepath = xrd(fn) if batch_mode else fn
-#         logging.debug('Load events [%d, %d) from file %s' % (start, stop, filepath))
-        a = root2array(filepath, treename=md.treename, selection=md.selection, branches=use_branches, start=start, stop=stop)
+    for filepath, entries in _job_entries(md, jobid, events, batch_mode, plan):
+        a = _retry(read_entries, filepath, md.treename, use_branches, entries)
         pieces.append(a)
     rec = np.concatenate(pieces)
     if rec.shape[0] == 0:
+        if not dryrun:
+            write_manifest(outname if batch_mode else output, key, 0)
         return
-    if not test_sample:
-        # important: shuffle the array if not for testing
-        np.random.shuffle(rec)
+    # important: shuffle the events if not for testing
+    # the permutation is applied column by column when writing
+    perm = None if test_sample else np.random.permutation(rec.shape[0])
 
     if batch_mode:
         if not dryrun:
             _write(rec, outname)
+            write_manifest(outname, key, rec.shape[0])
         logging.info(log_prefix + 'Writing output to: \n' + outname)
     else:
         output_tmp = output + '.tmp'
         if not dryrun:
             _write(rec, output_tmp)
             os.rename(output_tmp, output)
+            write_manifest(output, key, rec.shape[0])
         logging.info(log_prefix + 'Writing output to: \n' + output)
 
     logging.info(log_prefix + 'Done!')
 
-def writeData_lowMem(md, outputdir, jobid, batch_mode=False, test_sample=False, events=200000, dryrun=False):
-    ''' Convert input files to a HDF file. '''
-    from root_numpy import root2array
+def writeData_lowMem(md, outputdir, jobid, batch_mode=False, test_sample=False, events=200000, dryrun=False, column_group_size=10, plan=None, total_weight=False, group_vars=False, ragged=False, image_format='dense'):
+    ''' Convert input files to a HDF file, loading only a group of columns at a time.
+        The selection is evaluated once per file into a list of entries, which is then used to read each column group. '''
 
     log_prefix = '[%d] ' % jobid
-    outname = '{type}_file_{jobid}.h5'.format(type='test' if test_sample else 'train', jobid=jobid)
+    outname = output_name(jobid, test_sample)
     output = os.path.join(outputdir, outname)
-    if os.path.exists(output) and os.path.getsize(output) > 100 * 1024 * 1024:
-        # ignore if > 100M
-        logging.info(log_prefix + 'File %s already exist! Skipping.' % output)
+    key = output_key(md, jobid, events, test_sample, plan, output_options(total_weight, group_vars, ragged, image_format))
+    if is_complete(output, key):
+        logging.info(log_prefix + 'File %s already complete! Skipping.' % output)
         return
 
-    frac = float(events) / sum(md.num_events)
-#     use_branches = set(md.var_branches + md.var_no_transform_branches + md.label_branches + md.reweight_classes + md.reweight_var)
-#     if md.var_img:
-#         use_branches |= set([md.var_img] + md.var_pos)
     logging.debug(log_prefix + 'Start loading from root files')
 
+    # evaluate the selection only once per file
+    file_entries = _job_entries(md, jobid, events, batch_mode, plan)
+
     def _load_raw(branches):
-        pieces = []
-        for fn, n in zip(md.inputfiles, md.num_events):
-            step = int(math.ceil(frac * n))
-            start = step * jobid
-            stop = start + step
-            if start >= n:
-                continue
-            filepath = xrd(fn) if batch_mode else fn
-    #         logging.debug('Load events [%d, %d) from file %s' % (start, stop, filepath))
-            trial = 0
-            while trial < 5:
-                try:
-                    a = root2array(filepath, treename=md.treename, selection=md.selection, branches=branches, start=start, stop=stop)
-                    break
-                except:
-                    logging.error('Error reading %s:\n%s' % (filepath, traceback.format_exc()))
-                    time.sleep(10)
-                    trial += 1
-            if trial >= 5:
-                raise RuntimeError('Cannot read file %s' % filepath)
-            pieces.append(a)
-        rec = np.concatenate(pieces)
-        return rec
+        pieces = [_retry(read_entries, filepath, md.treename, branches, entries) for filepath, entries in file_entries]
+        return np.concatenate(pieces)
 
     # first make the labels, weights, and no-transform vars
-    use_branches = set(md.var_no_transform_branches + md.label_branches + md.reweight_classes + md.reweight_var)
+    use_branches = list(set(md.var_no_transform_branches + md.label_branches + md.reweight_classes + md.reweight_var))
     rec = _load_raw(use_branches)
     if rec.shape[0] == 0:
+        if not dryrun:
+            write_manifest(outname if batch_mode else output, key, 0)
         return
-    if not test_sample:
-        # important: shuffle the array if not for testing
-        shuffle_indices = np.arange(rec.shape[0])
-        np.random.shuffle(shuffle_indices)
-        rec = rec[shuffle_indices]
-
-    def _load(branches):
-        a = _load_raw(branches)
-        if test_sample:
-            return a
-        else:
-            return a[shuffle_indices]
+    # important: shuffle the events if not for testing
+    # the same permutation is applied to every column group when writing
+    perm = None if test_sample else np.random.permutation(rec.shape[0])
 
     def _write(output):
         logging.debug(log_prefix + 'Start making output file')
         with tables.open_file(output, mode='w') as h5file:
-            _make_labels(md, rec, h5file)
+            _make_labels(md, rec, h5file, perm=perm)
             logging.debug(log_prefix + 'Start producing weights')
-            _make_weight(md, rec, h5file)
-            _make_class_weight(md, rec, h5file)
+            _make_weights(md, rec, h5file, perm=perm, total_weight=total_weight)
             logging.debug(log_prefix + 'Start writing observer variables')
-            _transform_var(md, rec, h5file, md.var_no_transform_branches, no_transform=True)
+            _transform_var(md, rec, h5file, md.var_no_transform_branches, no_transform=True, perm=perm)
             logging.debug(log_prefix + 'Start transforming variables')
-            for var in md.var_branches:
-                logging.debug(log_prefix + 'Transforming var: %s' % var)
-                a = _load([var])
-                _transform_var(md, a, h5file, [var])
+            # with group_vars, each column group is a contiguous range of channels of a single variable group
+            # with ragged, the sequence variables of a variable group are loaded together
+            var_lists = group_channels(md).values() if (group_vars or ragged) else [md.var_branches]
+            for var_list in var_lists:
+                size = md.branches_info[var_list[0]]['size']
+                step = len(var_list) if ragged and size and size > 1 else column_group_size
+                for i in range(0, len(var_list), step):
+                    cols = var_list[i:i + step]
+                    logging.debug(log_prefix + 'Transforming vars: %s' % ','.join(cols))
+                    a = _load_raw(list(set(cols) | set(_sort_keys(md, cols))))
+                    _transform_var(md, a, h5file, cols, perm=perm, group_vars=group_vars, ragged=ragged)
+                    del a
             if md.var_img:
                 logging.debug(log_prefix + 'Start making images')
-                a = _load([md.var_img] + md.var_pos)
-                _make_image(md, a, h5file, output='img')
+                a = _load_raw([md.var_img] + md.var_pos)
+                _make_image(md, a, h5file, output='img', perm=perm, image_format=image_format)
 
     if batch_mode:
         if not dryrun:
             _write(outname)
+            write_manifest(outname, key, rec.shape[0])
         logging.info(log_prefix + 'Writing output to: \n' + outname)
     else:
         output_tmp = output + '.tmp'
         if not dryrun:
             _write(output_tmp)
             os.rename(output_tmp, output)
+            write_manifest(output, key, rec.shape[0])
         logging.info(log_prefix + 'Writing output to: \n' + output)
 
     logging.info(log_prefix + 'Done!')
 
+def writeData_stream(md, outputdir, jobid, batch_mode=False, test_sample=False, events=200000, dryrun=False, chunk_size=10000, plan=None, total_weight=False, group_vars=False, ragged=False, image_format='dense'):
+    ''' Convert input files to a HDF file, processing fixed-size chunks of events
+        and appending them to extendable arrays to keep the memory usage bounded.
+        Each chunk is made of events of all the input files of the job and shuffled. '''
+
+    log_prefix = '[%d] ' % jobid
+    outname = output_name(jobid, test_sample)
+    output = os.path.join(outputdir, outname)
+    key = output_key(md, jobid, events, test_sample, plan, output_options(total_weight, group_vars, ragged, image_format))
+    if is_complete(output, key):
+        logging.info(log_prefix + 'File %s already complete! Skipping.' % output)
+        return
+
+    use_branches = set(md.var_branches + md.var_no_transform_branches + md.label_branches + md.reweight_classes + md.reweight_var)
+    use_branches |= set(_sort_keys(md, md.var_branches))
+    if md.var_img:
+        use_branches |= set([md.var_img] + md.var_pos)
+    use_branches = list(use_branches)
+
+    def _iter_chunks():
+        file_entries = _job_entries(md, jobid, events, batch_mode, plan)
+        if test_sample:
+            # keep the order of the input files
+            for filepath, entries in file_entries:
+                for chunk_start in range(0, len(entries), chunk_size):
+                    yield _retry(read_entries, filepath, md.treename, use_branches, entries[chunk_start:chunk_start + chunk_size])
+            return
+        # each chunk takes from every input file in proportion to its number of events, so that the events of the
+        # different files (e.g., samples and classes) are mixed when the chunk is shuffled
+        n_chunks = max(int(math.ceil(sum(len(entries) for _, entries in file_entries) / float(chunk_size))), 1)
+        for k in range(n_chunks):
+            pieces = []
+            for filepath, entries in file_entries:
+                start, stop = len(entries) * k // n_chunks, len(entries) * (k + 1) // n_chunks
+                if stop > start:
+                    pieces.append(_retry(read_entries, filepath, md.treename, use_branches, entries[start:stop]))
+            if pieces:
+                yield np.concatenate(pieces)
+
+    def _write(output):
+        logging.debug(log_prefix + 'Start making output file')
+        n_written = 0
+        with tables.open_file(output, mode='w') as h5file:
+            for rec in _iter_chunks():
+                # important: shuffle the events if not for testing
+                perm = None if test_sample else np.random.permutation(rec.shape[0])
+                _make_labels(md, rec, h5file, append=True, perm=perm)
+                _make_weights(md, rec, h5file, append=True, perm=perm, total_weight=total_weight)
+                _transform_var(md, rec, h5file, md.var_no_transform_branches, no_transform=True, append=True, perm=perm)
+                _transform_var(md, rec, h5file, md.var_branches, append=True, perm=perm, group_vars=group_vars, ragged=ragged)
+                if md.var_img:
+                    _make_image(md, rec, h5file, output='img', append=True, perm=perm, image_format=image_format)
+                n_written += rec.shape[0]
+                logging.debug(log_prefix + '%d events written' % n_written)
+        return n_written
+
+    if batch_mode:
+        if not dryrun:
+            n_written = _write(outname)
+            if n_written == 0:
+                os.remove(outname)
+            write_manifest(outname, key, n_written)
+            if n_written == 0:
+                return
+        logging.info(log_prefix + 'Writing output to: \n' + outname)
+    else:
+        output_tmp = output + '.tmp'
+        if not dryrun:
+            n_written = _write(output_tmp)
+            if n_written == 0:
+                os.remove(output_tmp)
+                write_manifest(output, key, 0)
+                return
+            os.rename(output_tmp, output)
+            write_manifest(output, key, n_written)
+        logging.info(log_prefix + 'Writing output to: \n' + output)
+
+    logging.info(log_prefix + 'Done!')
+
+
+def get_writer(args):
+    ''' Select the conversion function according to the command line options. '''
+    if args.stream:
+        return functools.partial(writeData_stream, chunk_size=args.chunk_size, total_weight=args.total_weight, group_vars=args.group_vars, ragged=args.ragged, image_format=args.image_format)
+    elif args.low_mem:
+        return functools.partial(writeData_lowMem, column_group_size=args.column_group_size, total_weight=args.total_weight, group_vars=args.group_vars, ragged=args.ragged, image_format=args.image_format)
+    else:
+        return functools.partial(writeData, total_weight=args.total_weight, group_vars=args.group_vars, ragged=args.ragged, image_format=args.image_format)
+
+def add_writer_args(parser):
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--stream',
+        action='store_true', default=False,
+        help='Convert in fixed-size chunks of events to keep the memory usage bounded. Default: %(default)s'
+    )
+    parser.add_argument('--chunk-size',
+        type=int, default=10000,
+        help='Number of events per chunk in the streaming mode. Default: %(default)s'
+    )
+    mode.add_argument('--low-mem',
+        action='store_true', default=False,
+        help='Load only a group of columns at a time. Default: %(default)s'
+    )
+    parser.add_argument('--column-group-size',
+        type=int, default=10,
+        help='Number of columns loaded together in the low-memory mode. Default: %(default)s'
+    )
+    parser.add_argument('--total-weight',
+        action='store_true', default=False,
+        help='Also write the product weight*class_weight as `total_weight`, read directly by the data loader. Default: %(default)s'
+    )
+    parser.add_argument('--group-vars',
+        action='store_true', default=False,
+        help='Write the variables of each variable group as the channels of a single (n, C, W) dataset `group_<name>`, read at once by the data loader. Default: %(default)s'
+    )
+    parser.add_argument('--ragged',
+        action='store_true', default=False,
+        help='Write the sequence variables of each variable group without padding, as flat values `ragged_<name>` and row offsets `ragged_<name>_offsets`; the data loader pads them when making the batches. Default: %(default)s'
+    )
+    parser.add_argument('--image-format',
+        default='dense', choices=['dense', 'pixels', 'particles'],
+        help='Storage of the jet images: dense arrays, the non-empty pixels of each jet, or the particles of each jet to be binned by the data loader at any resolution. Default: %(default)s'
+    )
+    parser.add_argument('--staging-dir',
+        default=None,
+        help='Copy the input files to this local directory before reading them, and keep them there as a cache. Default: %(default)s'
+    )
+    parser.add_argument('--staging-quota',
+        type=float, default=50,
+        help='Disk quota of the staging directory in GB; the least recently used files are removed beyond it. Default: %(default)s'
+    )
+    parser.add_argument('--prefetch-threads',
+        type=int, default=2,
+        help='Number of threads staging the upcoming input files in the background. Default: %(default)s'
+    )
+
+def writer_cmdline(args):
+    ''' Command line options for `add_writer_args` to be passed to the batch jobs. '''
+    opts = []
+    if args.stream:
+        opts.append('--stream --chunk-size %d' % args.chunk_size)
+    elif args.low_mem:
+        opts.append('--low-mem --column-group-size %d' % args.column_group_size)
+    if args.total_weight:
+        opts.append('--total-weight')
+    if args.group_vars:
+        opts.append('--group-vars')
+    if args.ragged:
+        opts.append('--ragged')
+    if args.image_format != 'dense':
+        opts.append('--image-format %s' % args.image_format)
+    if args.staging_dir:
+        opts.append('--staging-dir %s --staging-quota %g --prefetch-threads %d' % (args.staging_dir, args.staging_quota, args.prefetch_threads))
+    return ' '.join(opts)
+
+def setup_staging(args):
+    ''' Read the input files through a local staging cache if `--staging-dir` is set. '''
+    if args.staging_dir:
+        set_staging(StagingCache(args.staging_dir, quota_gb=args.staging_quota, nthreads=args.prefetch_threads))
 
 def batch_write(args):
     from metadata import Metadata
+    setup_staging(args)
     md = Metadata(None)
     md.loadMetadata(args.metadata)
-    writeData(md, outputdir=args.outputdir, jobid=args.jobid, batch_mode=True,
-              test_sample=args.test_sample, events=args.events_per_file)
-
+    md.setSelectionIndex(os.path.join(os.path.dirname(args.metadata), SELECTION_INDEX_FILE))
+    plan = load_plan(args.plan) if args.plan else None
+    write = get_writer(args)
+    write(md, outputdir=args.outputdir, jobid=args.jobid, batch_mode=True,
+          test_sample=args.test_sample, events=args.events_per_file, plan=plan)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(levelname)s: %(message)s')
@@ -278,6 +865,11 @@ if __name__ == '__main__':
         action='store_true', default=False,
         help='Convert testing data instead of training/validation data. Default: %(default)s'
     )
+    add_writer_args(parser)
+    parser.add_argument('--plan',
+        default=None,
+        help='Path to the job plan file. Default: %(default)s'
+    )
     parser.add_argument('outputdir', help='Output directory for the metadata files.')
     parser.add_argument('jobid', type=int, help='Index of the output job.')
 
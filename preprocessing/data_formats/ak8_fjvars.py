@@ -97,3 +97,6 @@ var_img = None
 var_pos = None
 n_pixels = None
 img_ranges = None
+clip_range = None
+storage_types = None
+sort_by = None
@@ -69,3 +69,6 @@ var_img = 'pfcand_ptrel'
 var_pos = ['pfcand_etarel', 'pfcand_phirel']
 n_pixels = 64
 img_ranges = [[-0.8, 0.8], [-0.8, 0.8]]
+clip_range = None
+storage_types = None
+sort_by = None
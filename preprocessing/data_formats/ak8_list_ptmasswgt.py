@@ -112,3 +112,15 @@ var_img = None
 var_pos = None
 n_pixels = None
 img_ranges = None
+clip_range = None
+storage_types = [
+    # (regex, type): 'float16', an integer type for exact storage of integer-valued (flag/categorical) variables,
+    # or [integer type, scale, offset] for quantization; the data loader widens them back to float32
+    ('part_(isMu|isEl|isChargedHad|isGamma|isNeutralHad|charge|VTX_ass)$', 'int8'),
+    ('event_no$', 'uint32'),
+    # the other (standardized) particle and SV features; the first matching pattern is used
+    ('(part|sv)_', 'float16'),
+    ]
+# sort the sequence variables of a group by a key at conversion (padding stays at the end), e.g.,
+# {'part': {'var': 'part_ptrel', 'descend': True}}; the data loader then skips sorting the group
+sort_by = None
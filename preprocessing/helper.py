@@ -7,6 +7,29 @@ Helper functions for conversion.
 import numpy as np
 import logging
 
+from readers import get_reader
+
+_staging = None  # StagingCache used to read the input files, if any
+
+def set_staging(cache):
+    '''Read the input files through a local staging cache (see staging.py), or directly if None.'''
+    global _staging
+    _staging = cache
+
+def prefetch(filepaths, upcoming=()):
+    '''Start staging the input files of the current job and the `upcoming` ones (e.g., of the next job) in the background,
+    and keep them in the cache until the next call (no-op without a staging cache).'''
+    if _staging is not None:
+        _staging.prefetch(filepaths, upcoming)
+
+def invalidate(filepath):
+    '''Drop the staged copy of an input file, e.g., after a read error.'''
+    if _staging is not None:
+        _staging.invalidate(filepath)
+
+def _local(filepath):
+    return _staging.fetch(filepath) if _staging is not None else filepath
+
 def xrd(filepath):
     prefix = ''
     if filepath.startswith('/eos/cms'):
@@ -19,24 +42,172 @@ def xrd(filepath):
         return filepath
 
 def get_num_events(filepath, treename, selection=None):
-    import ROOT as rt
-    rt.gROOT.SetBatch(True)
     import traceback
     try:
-        f = rt.TFile.Open(filepath)
-        tree = f.Get(str(treename))
-        if not tree:
-            raise RuntimeError('Cannot find tree %s in file %s' % (treename, filepath))
+        filepath = _local(filepath)
+        reader = get_reader(filepath)
+        num_entries = reader.num_entries(filepath, treename)
         if selection is None:
-            return tree.GetEntries()
+            return num_entries
         else:
-            return tree.GetEntries(selection)
+            return int(np.count_nonzero(reader.evaluate(filepath, treename, selection, 0, num_entries)))
     except:
         logging.error('Error reading %s:\n%s' % (filepath, traceback.format_exc()))
         return None
 
-# borrowed from keras
-# https://github.com/fchollet/keras/blob/master/keras/preprocessing/sequence.py
+def get_branches(filepath, treename):
+    '''Returns the names of all the branches of the tree.'''
+    filepath = _local(filepath)
+    return get_reader(filepath).branches(filepath, treename)
+
+def get_selected_entries(filepath, treename, selection=None, start=0, stop=None):
+    '''Returns the entry numbers in [start, stop) passing the selection.
+    The selection is evaluated only once, as an expression of the branches (TTreeFormula syntax).'''
+    if selection is None:
+        if stop is None:
+            stop = get_num_events(filepath, treename)
+        return np.arange(start, stop, dtype=np.int64)
+    filepath = _local(filepath)
+    passed = get_reader(filepath).evaluate(filepath, treename, selection, start=start, stop=stop)
+    return np.flatnonzero(passed).astype(np.int64) + start
+
+def read_entries(filepath, treename, branches, entries, max_span=100000):
+    '''Reads the given branches for a sorted list of entries, without re-evaluating any selection.
+    The entries are read in ranges spanning at most `max_span` raw entries, so that the memory usage is bounded
+    however far apart the selected entries are.'''
+    filepath = _local(filepath)
+    reader = get_reader(filepath)
+    if len(entries) == 0:
+        return reader.read(filepath, treename, branches, start=0, stop=0)
+    entries = np.asarray(entries)
+    bounds = [0]
+    while bounds[-1] < len(entries):
+        bounds.append(int(np.searchsorted(entries, entries[bounds[-1]] + max_span)))
+    pieces = []
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        start = int(entries[i])
+        stop = int(entries[j - 1]) + 1
+        a = reader.read(filepath, treename, branches, start=start, stop=stop)
+        pieces.append(a if j - i == stop - start else a[entries[i:j] - start])
+    return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+def flatten_jagged(sequences):
+    '''Builds a flat (values, offsets) view of a jagged column.
+    `sequences` can be an object array (e.g., from root_numpy), a list of
+    sequences, or a dense 2D array. Row `i` is values[offsets[i]:offsets[i+1]].
+    '''
+    if isinstance(sequences, np.ndarray) and sequences.dtype != object and sequences.ndim >= 2:
+        n, width = sequences.shape[:2]
+        values = sequences.reshape((n * width,) + sequences.shape[2:])
+        offsets = np.arange(0, n * width + 1, width, dtype=np.int64) if width else np.zeros(n + 1, dtype=np.int64)
+        return values, offsets
+    num_samples = len(sequences)
+    try:
+        lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=num_samples)
+    except TypeError:
+        raise ValueError('`sequences` must be a list of iterables.')
+    offsets = np.zeros(num_samples + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.zeros(0), offsets
+    values = np.concatenate([s for s in sequences if len(s)])
+    return values, offsets
+
+def pad_jagged(values, offsets, maxlen=None, dtype='int32',
+               padding='pre', truncating='pre', value=0., out=None):
+    '''Pads a flat (values, offsets) jagged column into a dense array of shape (n, maxlen) + sample_shape
+    with a single vectorized scatter. Arguments follow `pad_sequences`.
+    If `out` is given, the result is written into it instead of allocating a new array.
+    '''
+    if padding not in ('pre', 'post'):
+        raise ValueError('Padding type "%s" not understood' % padding)
+    if truncating not in ('pre', 'post'):
+        raise ValueError('Truncating type "%s" not understood' % truncating)
+
+    lengths = np.diff(offsets)
+    num_samples = len(lengths)
+    if maxlen is None:
+        maxlen = int(lengths.max()) if num_samples else 0
+    sample_shape = values.shape[1:]
+
+    if out is None:
+        x = np.empty((num_samples, maxlen) + sample_shape, dtype=dtype)
+    else:
+        x = out
+        if x.shape != (num_samples, maxlen) + sample_shape:
+            raise ValueError('Shape of `out` %s is different from expected shape %s' %
+                             (x.shape, (num_samples, maxlen) + sample_shape))
+    x.fill(value)
+    if len(values) == 0 or maxlen == 0:
+        return x
+
+    # slots to be filled, in row-major order
+    kept = np.minimum(lengths, maxlen)
+    cols = np.arange(maxlen)
+    first_col = np.zeros_like(kept) if padding == 'post' else maxlen - kept
+    mask = (cols >= first_col[:, np.newaxis]) & (cols < (first_col + kept)[:, np.newaxis])
+    if np.any(lengths > maxlen):
+        # gather the source element for each filled slot, skipping the truncated ones
+        skip = np.zeros_like(kept) if truncating == 'post' else lengths - kept
+        src = (offsets[:-1] + skip - first_col)[:, np.newaxis] + cols
+        x[mask] = values[src[mask]]
+    else:
+        x[mask] = values
+    return x
+
+def _pixel_indices(values, n_pixels, value_range):
+    '''Bin indices following `np.histogram2d` with `range`: uniform bins, the upper edge is
+    included in the last bin, and values outside the range (or NaN) are flagged with -1.'''
+    edges = np.linspace(value_range[0], value_range[1], n_pixels + 1)
+    idx = np.searchsorted(edges, values, side='right') - 1
+    idx[values == edges[-1]] -= 1
+    idx[(idx < 0) | (idx >= n_pixels)] = -1
+    return idx
+
+def fill_images(x, y, wgt, n_pixels, img_ranges, out=None):
+    '''Builds the 2D images of a chunk of jets at once.
+    `x`, `y` and `wgt` are jagged columns (one row per jet). All constituents are flattened,
+    binned together and accumulated with a single weighted `np.bincount`, with the same binning
+    as calling `np.histogram2d(x[i], y[i], bins=[n_pixels, n_pixels], range=img_ranges, weights=wgt[i])`
+    for each jet. The result is written to `out` (shape (n, n_pixels, n_pixels)) if given.
+    '''
+    x_vals, offsets = flatten_jagged(x)
+    y_vals, _ = flatten_jagged(y)
+    w_vals, _ = flatten_jagged(wgt)
+    num_samples = len(offsets) - 1
+    if out is None:
+        out = np.empty((num_samples, n_pixels, n_pixels), dtype=np.float32)
+    rows = np.repeat(np.arange(num_samples), np.diff(offsets))
+    ix = _pixel_indices(x_vals, n_pixels, img_ranges[0])
+    iy = _pixel_indices(y_vals, n_pixels, img_ranges[1])
+    inside = (ix >= 0) & (iy >= 0)
+    flat_index = (rows[inside] * n_pixels + ix[inside]) * n_pixels + iy[inside]
+    hist = np.bincount(flat_index, weights=w_vals[inside], minlength=num_samples * n_pixels * n_pixels)
+    out[...] = hist.reshape((num_samples, n_pixels, n_pixels))
+    return out
+
+def sparse_images(x, y, wgt, n_pixels, img_ranges):
+    '''Builds the 2D images of a chunk of jets in a sparse (COO) form, with the same binning as `fill_images`.
+    Returns the flat pixel index (ix * n_pixels + iy) and the intensity of the non-empty pixels of all the jets,
+    ordered by jet and pixel, and the number of non-empty pixels of each jet.
+    '''
+    x_vals, offsets = flatten_jagged(x)
+    y_vals, _ = flatten_jagged(y)
+    w_vals, _ = flatten_jagged(wgt)
+    num_samples = len(offsets) - 1
+    rows = np.repeat(np.arange(num_samples), np.diff(offsets))
+    ix = _pixel_indices(x_vals, n_pixels, img_ranges[0])
+    iy = _pixel_indices(y_vals, n_pixels, img_ranges[1])
+    inside = (ix >= 0) & (iy >= 0)
+    flat_index = (rows[inside] * n_pixels + ix[inside]) * n_pixels + iy[inside]
+    keys, inverse = np.unique(flat_index, return_inverse=True)
+    values = np.bincount(inverse, weights=w_vals[inside], minlength=len(keys))
+    nonzero = values != 0
+    keys = keys[nonzero]
+    pixels = (keys % (n_pixels * n_pixels)).astype(np.int32)
+    lengths = np.bincount(keys // (n_pixels * n_pixels), minlength=num_samples)
+    return pixels, values[nonzero].astype(np.float32), lengths
+
 def pad_sequences(sequences, maxlen=None, dtype='int32',
                   padding='pre', truncating='pre', value=0.):
     """Pads each sequence to the same length (length of the longest sequence).
@@ -45,6 +216,38 @@ def pad_sequences(sequences, maxlen=None, dtype='int32',
     Truncation happens off either the beginning (default) or
     the end of the sequence.
     Supports post-padding and pre-padding (default).
+    The jagged input is flattened once and scattered into the output in a single vectorized step.
+    # Arguments
+        sequences: list of lists where each element is a sequence
+        maxlen: int, maximum length
+        dtype: type to cast the resulting sequence.
+        padding: 'pre' or 'post', pad either before or after each sequence.
+        truncating: 'pre' or 'post', remove values from sequences larger than
+            maxlen either in the beginning or in the end of the sequence
+        value: float, value to pad the sequences to the desired value.
+    # Returns
+        x: numpy array with dimensions (number_of_sequences, maxlen)
+    # Raises
+        ValueError: in case of invalid values for `truncating` or `padding`,
+            or in case of invalid shape for a `sequences` entry.
+    """
+    if not hasattr(sequences, '__len__'):
+        raise ValueError('`sequences` must be iterable.')
+    values, offsets = flatten_jagged(sequences)
+    return pad_jagged(values, offsets, maxlen=maxlen, dtype=dtype,
+                      padding=padding, truncating=truncating, value=value)
+
+# borrowed from keras
+# https://github.com/fchollet/keras/blob/master/keras/preprocessing/sequence.py
+def _pad_sequences_loop(sequences, maxlen=None, dtype='int32',
+                  padding='pre', truncating='pre', value=0.):
+    """Reference (per-sequence loop) implementation of `pad_sequences`, kept for benchmarking.
+    Pads each sequence to the same length (length of the longest sequence).
+    If maxlen is provided, any sequence longer
+    than maxlen is truncated to maxlen.
+    Truncation happens off either the beginning (default) or
+    the end of the sequence.
+    Supports post-padding and pre-padding (default).
     # Arguments
         sequences: list of lists where each element is a sequence
         maxlen: int, maximum length
@@ -0,0 +1,88 @@
+'''
+Completion manifests of the conversion jobs.
+
+After an output file is written, a manifest is stored next to it (with the
+suffix `MANIFEST_SUFFIX`). It records the key of the job, i.e., the hashes of
+the metadata and of the input slice of the job, the converter version and the
+writer options, together with the file size and the row count, shape, dtype and
+checksum of every dataset. A job is complete if its manifest has the same key
+and the output file still matches the recorded sizes and checksums, so re-runs
+skip exactly the complete jobs and redo the stale or corrupt ones.
+
+@author: hqu
+'''
+
+import os
+import json
+import zlib
+import hashlib
+import logging
+
+import tables
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+def _hash(obj):
+    content = json.dumps(obj, sort_keys=True, default=lambda o: o.tolist())
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def metadata_hash(md):
+    ''' Hash of the metadata content (the attributes written to the metadata file and loaded back). '''
+    return _hash({k: v for k, v in md.__dict__.items() if not k.startswith('_')})
+
+def job_key(md, jobid, events, test_sample, plan, version, options=None):
+    ''' Everything the content of the output of a job depends on. '''
+    job_slice = plan['jobs'][jobid] if plan else {'jobid': jobid, 'events': events}
+    return {'metadata': metadata_hash(md),
+            'slice': _hash(job_slice),
+            'test_sample': test_sample,
+            'version': version,
+            'options': options or {},
+            }
+
+def manifest_path(output):
+    return output + MANIFEST_SUFFIX
+
+def _summarize(output, chunk_rows=10000):
+    ''' Row count, shape, dtype and checksum of every dataset in the file. '''
+    datasets = {}
+    with tables.open_file(output) as f:
+        for node in f.walk_nodes('/', 'Leaf'):
+            checksum = 0
+            for start in range(0, node.shape[0], chunk_rows):
+                checksum = zlib.crc32(node[start:start + chunk_rows].tobytes(), checksum)
+            datasets[node._v_pathname] = {'rows': int(node.shape[0]), 'shape': list(node.shape[1:]),
+                                          'dtype': str(node.dtype), 'crc32': checksum & 0xffffffff}
+    return datasets
+
+def write_manifest(output, key, rows):
+    ''' Record the job `key` and the summary of the `output` file (no file is expected if `rows` is 0). '''
+    content = {'key': key, 'rows': rows, 'size': None, 'datasets': {}}
+    if rows > 0:
+        content['size'] = os.path.getsize(output)
+        content['datasets'] = _summarize(output)
+    tmpfile = manifest_path(output) + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(content, f, indent=1, sort_keys=True, default=lambda o: o.tolist())
+    os.rename(tmpfile, manifest_path(output))
+
+def is_complete(output, key):
+    ''' Check if the output of a job with the given `key` has been completely written and is still valid. '''
+    try:
+        with open(manifest_path(output)) as f:
+            content = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    if content['key'] != key:
+        logging.info('Output %s is stale' % output)
+        return False
+    if content['rows'] == 0:
+        return True
+    try:
+        if os.path.getsize(output) != content['size'] or _summarize(output) != content['datasets']:
+            logging.warning('Output %s does not match its manifest' % output)
+            return False
+    except Exception:
+        logging.warning('Cannot read output %s' % output)
+        return False
+    return True
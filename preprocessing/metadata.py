@@ -9,11 +9,64 @@ from __future__ import print_function
 import os
 import re
 import json
+import time
 import logging
+import traceback
+import functools
+import multiprocessing
 import numpy as np
-import pandas as pd
 
-from helper import get_num_events
+from helper import get_num_events, get_selected_entries, read_entries, get_branches
+from readers import input_extensions
+from selection_index import SelectionIndex, SELECTION_INDEX_FILE
+from sketch import VarStats
+from stats_store import StatsStore, STATS_STORE_FILE
+
+def _index_file(treename, selection, filepath):
+    ''' Count the entries of one file and find the ones passing the selection. '''
+    nevts = get_num_events(filepath, treename)
+    if not nevts:
+        return nevts, None
+    try:
+        return nevts, get_selected_entries(filepath, treename, selection, 0, nevts)
+    except Exception:
+        # e.g., a branch of the selection is missing or corrupt: the file is skipped
+        logging.error('Error evaluating the selection on %s:\n%s' % (filepath, traceback.format_exc()))
+        return None, None
+
+CHUNK_SIZE = 100000  # number of entries read at once per file
+
+def _file_stats(treename, branches, chunk_size, args):
+    ''' Read the selected entries of one file once, with all the branches, and return {branch: VarStats}. '''
+    filepath, entries = args
+    stats = {var: VarStats() for var in branches}
+    for start in range(0, len(entries), chunk_size):
+        rec = read_entries(filepath, treename, branches, entries[start:start + chunk_size])
+        for var in branches:
+            stats[var].update(rec[var])
+    return stats
+
+def _reweight_hists(rec, reweight_classes, reweight_var, reweight_bins, hists=None):
+    ''' Raw 2D histograms of the reweighting variables for each class, which can be summed over files.
+        Accumulate into `hists` if given. '''
+    if hists is None:
+        hists = {}
+    for label in reweight_classes:
+        pos = (rec[label] == 1)
+        x = np.minimum(rec[reweight_var[0]][pos], max(reweight_bins[0]))
+        y = np.minimum(rec[reweight_var[1]][pos], max(reweight_bins[1]))
+        h = np.histogram2d(x, y, bins=reweight_bins)[0]
+        hists[label] = hists[label] + h if label in hists else h
+    return hists
+
+def _file_reweight_hists(treename, reweight_classes, reweight_var, reweight_bins, chunk_size, args):
+    ''' Stream the selected entries of one file in chunks into the per-class reweighting histograms. '''
+    filepath, entries = args
+    hists = None
+    for start in range(0, max(len(entries), 1), chunk_size):
+        rec = read_entries(filepath, treename, reweight_classes + reweight_var, entries[start:start + chunk_size])
+        hists = _reweight_hists(rec, reweight_classes, reweight_var, reweight_bins, hists)
+    return hists
 
 class Metadata(object):
 
@@ -38,6 +91,10 @@ class Metadata(object):
                  var_pos=['pfcand_etarel', 'pfcand_phirel'],
                  n_pixels=64,
                  img_ranges=[[-0.8, 0.8], [-0.8, 0.8]],
+                 clip_range=None,
+                 storage_types=None,
+                 sort_by=None,
+                 nproc=1,
                  ):
         self._inputdir = inputdir  # data members starting with '_' is not loaded from json
 
@@ -62,12 +119,23 @@ class Metadata(object):
         self.var_pos = var_pos
         self.n_pixels = n_pixels
         self.img_ranges = img_ranges
+        self.clip_range = clip_range  # [min, max] of the transformed variables, no clipping if None
+        self.storage_types = storage_types  # [(regex, type)] storage types of the variables, float32 if not matched
+        self.sort_by = sort_by  # {v_group: {'var': key, 'descend': bool}} sorting of the sequence variables at conversion
+        self._nproc = nproc  # number of processes for reading the input files
 
         self.inputfiles = None
         self.num_events = None
+        self.num_selected = None
+        self._selection_index = None
+        self._stats_store = None
 
     def produceMetadata(self, filepath):
         logging.info('Start producing metadata...')
+        if self._selection_index is None:
+            self.setSelectionIndex(os.path.join(os.path.dirname(filepath), SELECTION_INDEX_FILE))
+        if self._stats_store is None:
+            self.setStatsStore(os.path.join(os.path.dirname(filepath), STATS_STORE_FILE))
         # make file list
         self.updateFilelist()
         # make var list
@@ -76,22 +144,91 @@ class Metadata(object):
         self._make_weights()
         # make transfromation info
         self._make_infos()
+        self._recordFiles()
         # write metadata
         self.writeMetadata(filepath)
 
+    def refreshMetadata(self, filepath, freeze_transform=False):
+        ''' Update the file list, the reweighting info and the transformation info, only reading the new or
+            modified input files and merging them with the stored per-file accumulators.
+            If `freeze_transform`, keep the current variables and transformation info, so that the files
+            converted before remain compatible. '''
+        logging.info('Start refreshing metadata...')
+        if self._selection_index is None:
+            self.setSelectionIndex(os.path.join(os.path.dirname(filepath), SELECTION_INDEX_FILE))
+        if self._stats_store is None:
+            self.setStatsStore(os.path.join(os.path.dirname(filepath), STATS_STORE_FILE))
+        self.updateFilelist()
+        self._stats_store.prune(self.inputfiles)
+        new_files = set(fn for fn in self.inputfiles if not self._stats_store.has(fn))
+        logging.info('%d new or modified files out of %d' % (len(new_files), len(self.inputfiles)))
+        self._make_weights(new_files)
+        if freeze_transform:
+            logging.info('Keeping the transformation info unchanged')
+            # the statistics of these files are added by the next refresh without `freeze_transform`
+            for fn in new_files:
+                self._stats_store.set_stats_pending(fn, True)
+        else:
+            pending = set(fn for fn in self.inputfiles if self._stats_store.stats_pending(fn))
+            if pending:
+                logging.info('Adding the statistics of %d files left out by a refresh with frozen transformation' % len(pending))
+            self._make_varlist()
+            self._make_infos(new_files | pending)
+            for fn in pending:
+                self._stats_store.set_stats_pending(fn, False)
+        self._recordFiles()
+        self.writeMetadata(filepath)
+
     def loadMetadata(self, filepath):
         with open(filepath) as metafile:
-            md = json.load(metafile, encoding='ascii')
+            md = json.load(metafile)
             for k in md:
                 if k.startswith('_'): continue
                 setattr(self, k, md[k])
         logging.info('Metadata loaded from ' + filepath)
 
+    def setSelectionIndex(self, filepath):
+        ''' Read (and update) the passing entries of each input file from the index stored at `filepath`. '''
+        self._selection_index = SelectionIndex(filepath, self.treename, self.selection)
+
+    def saveSelectionIndex(self):
+        if self._selection_index is not None:
+            self._selection_index.save()
+
+    def setStatsStore(self, filepath):
+        ''' Read (and update) the per-file reweighting histograms and variable statistics stored at `filepath`. '''
+        self._stats_store = StatsStore(filepath, self.selection)
+
+    def saveStatsStore(self):
+        if self._stats_store is not None:
+            self._stats_store.save()
+
+    def _recordFiles(self):
+        # mark all the current input files as processed, so that only files added later are new on refresh
+        for fn in self.inputfiles:
+            self._stats_store.add(fn)
+        self.saveStatsStore()
+
+    def selectedEntries(self, fn, num_entries=None, filepath=None):
+        ''' Entries of the input file `fn` passing the selection, read through the selection index. '''
+        if self._selection_index is None:
+            # in-memory only
+            self.setSelectionIndex(None)
+        return self._selection_index.entries(fn, filepath=filepath, num_entries=num_entries)
+
+    def numSelected(self):
+        ''' Number of selected events in each input file. '''
+        if self.num_selected is None:
+            self.num_selected = [len(self.selectedEntries(fn, n)) for fn, n in zip(self.inputfiles, self.num_events)]
+            self.saveSelectionIndex()
+        return self.num_selected
+
     def updateFilelist(self, test_sample=False):
         import re
-        self.inputfiles = []
-        self.num_events = []
-        counter = 0
+        if self._selection_index is None:
+            # in-memory only
+            self.setSelectionIndex(None)
+        filelist = []
         for dp, dn, filenames in os.walk(self._inputdir):
             if 'failed' in dp or 'ignore' in dp:
                 continue
@@ -105,20 +242,54 @@ class Metadata(object):
 #                 # test samples
 #                 continue
             for f in filenames:
-                if not f.endswith('.root'):
+                if not f.endswith(input_extensions()):
                     continue
-                fullpath = os.path.join(dp, f)
-                nevts = get_num_events(fullpath, self.treename)
+                filelist.append(os.path.join(dp, f))
+
+        # files unchanged since the last run are taken from the index, the others are read in parallel
+        counts = {}
+        misses = []
+        for fullpath in filelist:
+            nevts = self._selection_index.num_entries(fullpath)
+            if nevts is None:
+                misses.append(fullpath)
+            else:
+                counts[fullpath] = (nevts, self._selection_index.num_selected(fullpath))
+        logging.info('Found %d files, %d unchanged, %d to be read' % (len(filelist), len(counts), len(misses)))
+
+        func = functools.partial(_index_file, self.treename, self.selection)
+        pool = multiprocessing.Pool(min(self._nproc, len(misses))) if self._nproc > 1 and len(misses) > 1 else None
+        try:
+            results = pool.imap(func, misses) if pool else (func(fn) for fn in misses)
+            start_time = time.time()
+            processed_events = 0
+            for counter, (fullpath, (nevts, entries)) in enumerate(zip(misses, results), 1):
                 if nevts:
-                    self.inputfiles.append(fullpath)
-                    self.num_events.append(nevts)
-                    counter += 1
-                    if counter%10==0:
-                        logging.debug('%d files processed...' % counter)
-                else:
-                    logging.warning('Ignore erroneous file %s' % fullpath)
-        self._total_events = sum(self.num_events)
-        logging.info('Created file list from directory %s\nFiles:%d, Events:%d' % (self._inputdir, len(self.inputfiles), self._total_events))
+                    self._selection_index.update(fullpath, entries, nevts)
+                    counts[fullpath] = (nevts, len(entries))
+                    processed_events += nevts
+                if counter % 10 == 0 or counter == len(misses):
+                    elapsed = max(time.time() - start_time, 1e-6)
+                    logging.debug('%d/%d files processed (%.1f files/s, %.0f events/s)...' %
+                                  (counter, len(misses), counter / elapsed, processed_events / elapsed))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        self.inputfiles = []
+        self.num_events = []
+        self.num_selected = []
+        for fullpath in filelist:
+            if fullpath in counts:
+                self.inputfiles.append(fullpath)
+                self.num_events.append(counts[fullpath][0])
+                self.num_selected.append(counts[fullpath][1])
+            else:
+                logging.warning('Ignore erroneous file %s' % fullpath)
+        self.saveSelectionIndex()
+        self._total_events = sum(self.num_selected)
+        logging.info('Created file list from directory %s\nFiles:%d, Events:%d, Selected:%d' % (self._inputdir, len(self.inputfiles), sum(self.num_events), self._total_events))
         return (self.inputfiles, self.num_events)
 
     def updateWeights(self, test_sample=False):
@@ -128,16 +299,15 @@ class Metadata(object):
             self._make_weights()
 
     def writeMetadata(self, filepath):
+        content = {k: v for k, v in self.__dict__.items() if k not in ('_selection_index', '_stats_store', '_nproc', '_weight_table')}
         with open(filepath, 'w') as metafile:
-            json.dump(self.__dict__, metafile, indent=2, encoding='ascii', sort_keys=True)
+            json.dump(content, metafile, indent=2, sort_keys=True, default=lambda o: o.tolist())
         logging.info('Metadata written to ' + filepath)
 
 
     def _make_varlist(self):
         # get all branches and filter them using input variable list
-        from root_numpy import root2array
-        df = pd.DataFrame(root2array(self.inputfiles[0], treename=self.treename, stop=1))
-        self._all_branches = df.columns.values.tolist()
+        self._all_branches = get_branches(self.inputfiles[0], self.treename)
         self.var_branches = []
         self.var_sizes = {}
         for k in self._all_branches:
@@ -167,20 +337,17 @@ class Metadata(object):
         self.var_no_transform_branches = _var_no_transform
 
 
-    def _prepare_reweight_info(self, rec):
+    def _prepare_reweight_info(self, hists):
         ''' Produce metadata for reweighting. Goal:
             1) Produce flat pT spectrum.
             2) Balance the class weights on top of that
         '''
         class_events = {}
         result = {}
+        _, x_edges, y_edges = np.histogram2d([], [], bins=self._reweight_bins)
         for label in self.reweight_classes:
-            pos = (rec[label] == 1)
-            x = np.minimum(rec[self.reweight_var[0]][pos], max(self._reweight_bins[0]))
-            y = np.minimum(rec[self.reweight_var[1]][pos], max(self._reweight_bins[1]))
 #             class_events[label] = 0
-            hist, x_edges, y_edges = np.histogram2d(x, y, bins=self._reweight_bins)
-            hist = np.asfarray(hist, dtype=np.float32)
+            hist = np.asarray(hists[label], dtype=np.float32)
             result[label] = {'x_edges':x_edges.tolist(), 'y_edges':y_edges.tolist(), 'hist':hist, 'raw_hist':hist[:].tolist()}
             logging.debug('%s:\n%s' % (label, str(hist)))
 #             if min(hist[-2:]) < 10:
@@ -219,77 +386,139 @@ class Metadata(object):
                 result[label]['class_wgt'] = 1
         return result
 
-    def _make_weights(self):
+    def _make_weights(self, new_files=None):
+        ''' Make the reweighting info. If `new_files` is given, only read these files (and the ones without
+            stored histograms), and use the stored histograms of the others. '''
         if self.reweight_method == 'none':
             logging.info('-- Reweighting is disabled --')
             return
+        if self._stats_store is None:
+            # in-memory only
+            self.setStatsStore(None)
+        store = self._stats_store
+        store.check_config('hists', [self.reweight_var, self.reweight_classes, self._reweight_bins, self._reweight_events])
         # fraction of events to take from each file
-        from root_numpy import root2array
+        num_selected = self.numSelected()
         frac = 1.0
         if self._reweight_events > 0:
-            frac = float(self._reweight_events) / self._total_events
-        if frac < 1:
-            pieces = []
-            for fn, n in zip(self.inputfiles, self.num_events):
-                a = root2array(fn, treename=self.treename, selection=self.selection, stop=int(frac * n),
-                               branches=self.reweight_classes + self.reweight_var)
-                pieces.append(a)
-            rec = np.concatenate(pieces)
-        else:
-
-            rec = root2array(self.inputfiles, treename=self.treename, selection=self.selection,
-                               branches=self.reweight_classes + self.reweight_var)
-        logging.info('Use %d events to produce reweight info, selection:\n%s' % (rec.shape[0], self.selection))
+            frac = float(self._reweight_events) / sum(num_selected)
+        num_used = [int(frac * n) if frac < 1 else n for n in num_selected]
+        files = []
+        tasks = []
+        for fn, n, n_used in zip(self.inputfiles, self.num_events, num_used):
+            stored = store.hists_entries(fn)
+            # the stored histograms filled with fewer events than needed now (e.g., after files are removed) are remade
+            if new_files is None or fn in new_files or store.hists(fn) is None or stored is None or stored < n_used:
+                files.append(fn)
+                tasks.append((fn, self.selectedEntries(fn, n)[:n_used]))
+        # fill the histograms of the files to read in parallel, then sum the histograms of all the files
+        func = functools.partial(_file_reweight_hists, self.treename, self.reweight_classes, self.reweight_var, self._reweight_bins, CHUNK_SIZE)
+        for (fn, entries), file_hists in zip(tasks, self._map_files(func, tasks)):
+            store.set_hists(fn, file_hists, len(entries))
+        hists = {label: 0 for label in self.reweight_classes}
+        for fn, n_used in zip(self.inputfiles, num_used):
+            file_hists = store.hists(fn)
+            stored = store.hists_entries(fn)
+            # histograms stored with a larger fraction of the events (before files were added) count as the current one
+            scale = float(n_used) / stored if stored else 1.
+            for label in self.reweight_classes:
+                hists[label] = hists[label] + file_hists[label] * scale
+        num_read = len(files)
+        logging.info('Use %d events (%d files read) to produce reweight info, selection:\n%s' % (
+            sum(np.sum(hists[label]) for label in self.reweight_classes), num_read, self.selection))
         # get distribution for reweighting
-        self.reweight_info = self._prepare_reweight_info(rec)
+        self.reweight_info = self._prepare_reweight_info(hists)
         logging.debug('Reweight info:\n' + str(self.reweight_info))
 
-    def _make_infos(self):
-        # make variables transformation infos
-        from root_numpy import root2array
+    def _map_files(self, func, tasks):
+        ''' Apply `func` to each task (one per input file), in parallel over `nproc` processes if enabled,
+            and yield the results in order. '''
+        if self._nproc > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(self._nproc, len(tasks)))
+            try:
+                for res in pool.imap(func, tasks):
+                    yield res
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for t in tasks:
+                yield func(t)
+
+    def _sample_files(self, file_inds, num_events):
+        ''' Pick input files at random among `file_inds` (5x more than needed), and the fraction of their
+            selected entries to read to get about `num_events` events. '''
+        num_selected = self.numSelected()
+        file_inds = np.array(file_inds, dtype=np.int64)
         frac = 1.0
-        _inputfiles = self.inputfiles
-        _num_events = self.num_events
-        if self._metadata_events > 0:
-            nfiles = int(5 * float(self._metadata_events) / self._total_events * len(self.inputfiles))
-            file_inds = np.arange(len(self.inputfiles))
+        if sum(num_selected[i] for i in file_inds) == 0:
+            return [], {}
+        if num_events > 0:
+            # take files in random order until they hold 5x the events needed (at least one file with selected events)
             np.random.shuffle(file_inds)
+            cumsum = np.cumsum([num_selected[i] for i in file_inds])
+            nfiles = min(int(np.searchsorted(cumsum, 5 * float(num_events))) + 1, len(file_inds))
             file_inds = file_inds[:nfiles]
-            _inputfiles = [self.inputfiles[i] for i in file_inds]
-            _num_events = [self.num_events[i] for i in file_inds]
-            frac = float(self._metadata_events) / sum(_num_events)
+            frac = float(num_events) / cumsum[nfiles - 1]
+        _entries = {}
+        for i in file_inds:
+            fn = self.inputfiles[i]
+            entries = self.selectedEntries(fn, self.num_events[i])
+            _entries[fn] = entries[:int(frac * len(entries))] if frac < 1 else entries
+        return [self.inputfiles[i] for i in file_inds], _entries
+
+    def _make_infos(self, new_files=None):
+        ''' Make the variables transformation infos. If `new_files` is given, only sample among these files,
+            and merge them with the stored statistics of the other files. '''
+        if self._stats_store is None:
+            # in-memory only
+            self.setStatsStore(None)
+        store = self._stats_store
+        store.check_config('stats', [self.var_branches, self._metadata_events])
+        cached = []
+        if new_files is not None:
+            cached = [(fn, store.stats(fn)) for fn in self.inputfiles if fn not in new_files and store.stats(fn) is not None]
+        if cached:
+            file_inds = [i for i, fn in enumerate(self.inputfiles) if fn in new_files]
+            num_selected = self.numSelected()
+            num_events = self._metadata_events
+            if num_events > 0:
+                # new files contribute in proportion to their number of selected events
+                num_events = float(num_events) * sum(num_selected[i] for i in file_inds) / sum(num_selected)
+            _inputfiles, _entries = self._sample_files(file_inds, num_events)
+            logging.debug('Use stored statistics of %d files' % len(cached))
+        else:
+            # (re)make from scratch: drop any stored statistics
+            for fn in self.inputfiles:
+                if store.stats(fn) is not None:
+                    store.set_stats(fn, None)
+            _inputfiles, _entries = self._sample_files(range(len(self.inputfiles)), self._metadata_events)
 
-        first = True
+        logging.debug('Use %d events from %d files for var transform info' % (sum(len(e) for e in _entries.values()), len(_inputfiles)))
+
+        # read each file once with all the branches, in parallel over files, and merge the per-file statistics
+        func = functools.partial(_file_stats, self.treename, self.var_branches, CHUNK_SIZE)
+        tasks = [(fn, _entries[fn]) for fn in _inputfiles]
+        stats = {var: VarStats() for var in self.var_branches}
+
+        def _merge(results, store_results=True):
+            for fn, res in results:
+                if store_results:
+                    store.set_stats(fn, res)
+                for var in self.var_branches:
+                    stats[var].merge(res[var])
+
+        _merge(cached, store_results=False)
+        _merge(zip(_inputfiles, self._map_files(func, tasks)))
 
         self.branches_info = {}
         for var in self.var_branches:
             var_size = self.var_sizes[var]
-            pieces = []
-            for fn, n in zip(_inputfiles, _num_events):
-                v = root2array(fn, treename=self.treename, selection=self.selection,
-                               branches=var, stop=int(frac * n))
-                pieces.append(v)
-            a = np.concatenate(pieces)
-            if first:
-                first = False
-                logging.debug('Use %d events from %d files for var transform info' % (a.shape[0], len(_inputfiles)))
             size = None
-            if a.dtype == np.object:
+            if len(stats[var].lengths):
                 if var_size:
                     size = var_size  # use given size if provided
                 else:
-                    lengths = [len(row) for row in a]
-                    size = int(round(np.percentile(lengths, 95)))  # else get 95% percentile of the length
-                a = np.nan_to_num(np.concatenate(a))  # then flatten vector vars for calculations
-            else:
-                a = np.nan_to_num(a)
-            self.branches_info[var] = {
-                'size'  : size,
-                'median': float(np.percentile(a, 50)),  # need float otherwise cannot serialize to json
-                'upper' : float(np.percentile(a, 84)),
-                'min'   : float(np.min(a)),
-                'max'   : float(np.max(a)),
-                'mean'  : float(np.mean(a)),
-                'std'   : float(np.std(a)),
-                }
+                    size = int(round(stats[var].length_percentile(95)))  # else get 95% percentile of the length
+            self.branches_info[var] = stats[var].info(size)
             logging.debug(var + ': ' + str(self.branches_info[var]))
@@ -0,0 +1,59 @@
+'''
+Plan the input slices of the conversion jobs.
+
+Instead of reading a small slice of every input file in every job, each job
+gets a few contiguous ranges of selected entries from a small number of files.
+The input files are shuffled and dealt into `n_streams` streams, and every job
+takes the same fraction of each stream, so each output file mixes events from
+about `n_streams` input files. Further mixing across output files is left to
+the shuffle stage.
+
+@author: hqu
+'''
+
+import json
+import math
+import logging
+import numpy as np
+
+JOB_PLAN_FILE = 'jobplan.json'
+
+def make_plan(md, events, n_streams=4, seed=42):
+    ''' Returns the plan as a dict, with `jobs` being a list of [(filename, start, stop), ...],
+        where start/stop index the selected entries of each file. '''
+    counts = np.asarray(md.numSelected(), dtype=np.int64)
+    njobs = int(math.ceil(float(counts.sum()) / events))
+    order = np.random.RandomState(seed).permutation(len(counts))
+    order = order[counts[order] > 0]
+    n_streams = max(1, min(n_streams, len(order)))
+
+    jobs = [[] for _ in range(njobs)]
+    for s in range(n_streams):
+        stream = order[s::n_streams]
+        # position of each file in the concatenated stream
+        offsets = np.concatenate([[0], np.cumsum(counts[stream])])
+        total = offsets[-1]
+        for jobid in range(njobs):
+            begin = int(round(float(total) * jobid / njobs))
+            end = int(round(float(total) * (jobid + 1) / njobs))
+            if begin >= end:
+                continue
+            first = np.searchsorted(offsets, begin, side='right') - 1
+            last = np.searchsorted(offsets, end, side='left') - 1
+            for i in range(first, last + 1):
+                start = max(begin, offsets[i]) - offsets[i]
+                stop = min(end, offsets[i + 1]) - offsets[i]
+                jobs[jobid].append((md.inputfiles[stream[i]], int(start), int(stop)))
+
+    logging.info('Planned %d jobs with %d events each from %d files, %.1f files per job on average' %
+                 (njobs, events, len(order), np.mean([len(j) for j in jobs]) if jobs else 0))
+    return {'events': events, 'n_streams': n_streams, 'seed': seed, 'jobs': jobs}
+
+def write_plan(plan, filepath):
+    with open(filepath, 'w') as f:
+        json.dump(plan, f, indent=1)
+    logging.info('Job plan written to ' + filepath)
+
+def load_plan(filepath):
+    with open(filepath) as f:
+        return json.load(f)
@@ -0,0 +1,272 @@
+'''
+Input readers for preprocessing.
+
+A reader gives access to the trees of one kind of input file:
+ - `num_entries(filepath, treename)`: number of entries;
+ - `branches(filepath, treename)`: list of branch names;
+ - `read(filepath, treename, branches, start, stop)`: branches for an entry range,
+   as a 1D array for a single branch (str) or a structured array for a list of branches;
+   jagged branches are object arrays of per-entry arrays (as from root_numpy);
+ - `evaluate(filepath, treename, expression, start, stop)`: value of an expression
+   (e.g., the selection) for each entry in the range.
+The reader is chosen from the file extension with `get_reader`.
+
+`RootReader` reads ROOT files through root_numpy/PyROOT. `NpzReader` reads NumPy
+`.npz` files without ROOT: each regular branch is stored as an array named after
+the branch, and each jagged branch as a flat `<branch>.values` array plus a
+`<branch>.offsets` array of length n+1 (see `write_npz`). A npz file holds a
+single tree, so the tree name is ignored. Expressions are evaluated with a small
+evaluator of the TTreeFormula syntax on scalar branches (arithmetic, comparisons,
+&&, ||, !, and a few math functions).
+
+@author: hqu
+'''
+
+import ast
+import operator
+import numpy as np
+
+_string_types = (str, type(u''))
+
+class RootReader(object):
+
+    extensions = ('.root',)
+
+    def num_entries(self, filepath, treename):
+        import ROOT as rt
+        rt.gROOT.SetBatch(True)
+        f = rt.TFile.Open(filepath)
+        if not f or f.IsZombie():
+            raise RuntimeError('Cannot open file %s' % filepath)
+        tree = f.Get(str(treename))
+        if not tree:
+            raise RuntimeError('Cannot find tree %s in file %s' % (treename, filepath))
+        return tree.GetEntries()
+
+    def branches(self, filepath, treename):
+        from root_numpy import root2array
+        return list(root2array(filepath, treename=str(treename), stop=1).dtype.names)
+
+    def read(self, filepath, treename, branches, start=0, stop=None):
+        from root_numpy import root2array
+        return root2array(filepath, treename=str(treename), branches=branches, start=start, stop=stop)
+
+    def evaluate(self, filepath, treename, expression, start=0, stop=None):
+        from root_numpy import root2array
+        return root2array(filepath, treename=str(treename), branches=str(expression), start=start, stop=stop)
+
+_BINARY_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.Mod: np.fmod, ast.Pow: np.power,
+    }
+_COMPARE_OPS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+    }
+_FUNCTIONS = {
+    'abs': np.abs, 'fabs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'atan2': np.arctan2, 'pow': np.power,
+    'min': np.minimum, 'max': np.maximum,
+    # TMath
+    'Abs': np.abs, 'Sqrt': np.sqrt, 'Exp': np.exp, 'Log': np.log, 'Log10': np.log10, 'ATan2': np.arctan2,
+    'Power': np.power, 'Min': np.minimum, 'Max': np.maximum,
+    }
+
+_LOGICAL_OPS = [('||', ' or '), ('&&', ' and '), ('|', ' or '), ('&', ' and ')]
+
+def _split_top(expr, op):
+    ''' Split `expr` at the operator `op` outside of the parentheses (a single `&` or `|` is not part of `&&` or `||`). '''
+    parts, depth, last, i = [], 0, 0, 0
+    while i < len(expr):
+        c = expr[i]
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and expr.startswith(op, i) and (len(op) == 2 or op not in (expr[i - 1:i], expr[i + 1:i + 2])):
+            parts.append(expr[last:i])
+            last = i = i + len(op)
+            continue
+        i += 1
+    parts.append(expr[last:])
+    return parts
+
+def _group_logical(expr):
+    ''' Rewrite the C operators `||`, `&&`, `|` and `&` (lowest to highest precedence, all below the comparisons) as
+        python's `or`/`and`, with the parentheses needed to keep the C precedence, e.g., `a>1 & b<2` is `(a>1) and (b<2)`
+        rather than python's chained comparison `a > (1&b) < 2`. '''
+    for op, py_op in _LOGICAL_OPS:
+        parts = _split_top(expr, op)
+        if len(parts) > 1:
+            return py_op.join('(%s)' % _group_logical(part) for part in parts)
+    # no operator at this level: rewrite the expressions in parentheses
+    out, depth, start = [], 0, 0
+    for i, c in enumerate(expr):
+        if c == '(':
+            if depth == 0:
+                out.append(expr[start:i + 1])
+                start = i + 1
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                out.append(_group_logical(expr[start:i]))
+                start = i
+    out.append(expr[start:])
+    return ''.join(out)
+
+def _to_python_syntax(expression):
+    ''' Translate the TTreeFormula logical operators and namespaces to python syntax.
+        `!` binds tighter than the comparisons as in C (`!a == b` is `(!a) == b`), so it becomes the unary `~`
+        (evaluated as a logical not) rather than python's `not`. '''
+    expr = _group_logical(expression.replace('TMath::', '').replace('std::', ''))
+    out = []
+    for i, c in enumerate(expr):
+        if c == '!' and (i + 1 >= len(expr) or expr[i + 1] != '='):
+            out.append('~')
+        else:
+            out.append(c)
+    return ''.join(out)
+
+class _Evaluator(object):
+
+    ''' Evaluate a parsed expression on the columns returned by `column(name)`. '''
+
+    def __init__(self, column):
+        self.column = column
+
+    def __call__(self, node):
+        if isinstance(node, ast.Expression):
+            return self(node.body)
+        if isinstance(node, ast.BoolOp):
+            func = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            result = self(node.values[0])
+            for value in node.values[1:]:
+                result = func(result, self(value))
+            return result
+        if isinstance(node, ast.UnaryOp):
+            operand = self(node.operand)
+            if isinstance(node.op, ast.Not):
+                return np.logical_not(operand)
+            if isinstance(node.op, ast.USub):
+                return -operand
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if isinstance(node.op, ast.Invert):
+                return np.logical_not(operand)
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            return _BINARY_OPS[type(node.op)](self(node.left), self(node.right))
+        if isinstance(node, ast.Compare):
+            result = None
+            left = self(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self(comparator)
+                passed = _COMPARE_OPS[type(op)](left, right)
+                result = passed if result is None else np.logical_and(result, passed)
+                left = right
+            return result
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS:
+            return _FUNCTIONS[node.func.id](*[self(arg) for arg in node.args])
+        if isinstance(node, ast.Name):
+            if node.id in ('true', 'True'):
+                return True
+            if node.id in ('false', 'False'):
+                return False
+            return self.column(node.id)
+        if isinstance(node, getattr(ast, 'Constant', ())) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, getattr(ast, 'Num', ())):
+            return node.n
+        raise ValueError('Unsupported expression: %s' % ast.dump(node))
+
+class NpzReader(object):
+
+    extensions = ('.npz',)
+
+    def _columns(self, npz):
+        names = []
+        for key in npz.files:
+            if key.endswith('.offsets'):
+                continue
+            names.append(key[:-len('.values')] if key.endswith('.values') else key)
+        return names
+
+    def num_entries(self, filepath, treename):
+        with np.load(filepath) as npz:
+            key = npz.files[0]
+            if key.endswith('.values') or key.endswith('.offsets'):
+                return len(npz[key.rsplit('.', 1)[0] + '.offsets']) - 1
+            return len(npz[key])
+
+    def branches(self, filepath, treename):
+        with np.load(filepath) as npz:
+            return self._columns(npz)
+
+    def _read_column(self, npz, name, start, stop):
+        if name + '.offsets' in npz.files:
+            offsets = npz[name + '.offsets']
+            values = npz[name + '.values']
+            stop = len(offsets) - 1 if stop is None else min(stop, len(offsets) - 1)
+            start = min(start, stop)
+            out = np.empty(stop - start, dtype=object)
+            for i in range(start, stop):
+                out[i - start] = values[offsets[i]:offsets[i + 1]]
+            return out
+        if name in npz.files:
+            return npz[name][start:stop]
+        # not a branch: evaluate as an expression
+        return self._evaluate(npz, name, start, stop)
+
+    def _evaluate(self, npz, expression, start, stop):
+        def _column(name):
+            if name + '.offsets' in npz.files:
+                raise ValueError('Jagged branch %s cannot be used in an expression' % name)
+            if name not in npz.files:
+                raise KeyError('Branch %s not found' % name)
+            return npz[name][start:stop]
+        tree = ast.parse(_to_python_syntax(expression).strip(), mode='eval')
+        result = _Evaluator(_column)(tree)
+        n = len(_column(self._columns(npz)[0])) if np.ndim(result) == 0 else len(result)
+        return np.broadcast_to(result, (n,)).copy() if np.ndim(result) == 0 else np.asarray(result)
+
+    def read(self, filepath, treename, branches, start=0, stop=None):
+        with np.load(filepath) as npz:
+            if isinstance(branches, _string_types):
+                return self._read_column(npz, branches, start, stop)
+            if branches is None:
+                branches = self._columns(npz)
+            columns = [self._read_column(npz, name, start, stop) for name in branches]
+        out = np.empty(len(columns[0]) if columns else 0, dtype=[(str(name), c.dtype) for name, c in zip(branches, columns)])
+        for name, c in zip(branches, columns):
+            out[str(name)] = c
+        return out
+
+    def evaluate(self, filepath, treename, expression, start=0, stop=None):
+        with np.load(filepath) as npz:
+            return self._evaluate(npz, str(expression), start, stop)
+
+def write_npz(filepath, columns):
+    ''' Write the columns {branch: array} to a npz file readable by `NpzReader`.
+        Jagged columns (object arrays or lists of sequences) are stored as flat values and offsets. '''
+    arrays = {}
+    for name, col in columns.items():
+        if isinstance(col, np.ndarray) and col.dtype != object:
+            arrays[name] = col
+            continue
+        lengths = np.array([len(row) for row in col], dtype=np.int64)
+        arrays[name + '.offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        arrays[name + '.values'] = np.concatenate([np.asarray(row) for row in col]) if len(col) else np.zeros(0)
+    with open(filepath, 'wb') as f:
+        np.savez(f, **arrays)
+
+_READERS = [RootReader(), NpzReader()]
+
+def get_reader(filepath):
+    ''' Reader for the input file, chosen from the file extension (ROOT by default, e.g., for xrootd urls). '''
+    for reader in _READERS:
+        if filepath.endswith(reader.extensions):
+            return reader
+    return _READERS[0]
+
+def input_extensions():
+    return tuple(ext for reader in _READERS for ext in reader.extensions)
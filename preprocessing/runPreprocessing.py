@@ -8,11 +8,16 @@ from __future__ import print_function
 
 import os
 import math
+import shutil
 import argparse
 
 from metadata import Metadata
-from converter import writeData
-import multiprocessing
+from selection_index import SELECTION_INDEX_FILE
+from planner import JOB_PLAN_FILE, make_plan, write_plan, load_plan
+from converter import get_writer, add_writer_args, writer_cmdline, setup_staging, output_name, output_options, output_key
+from manifest import MANIFEST_SUFFIX, is_complete
+from scheduler import run_jobs
+from catalog import update_catalog
 import functools
 
 import logging
@@ -44,6 +49,10 @@ def create_metadata(args):
                   var_pos=d.var_pos,
                   n_pixels=d.n_pixels,
                   img_ranges=d.img_ranges,
+                  clip_range=d.clip_range,
+                  storage_types=d.storage_types,
+                  sort_by=d.sort_by,
+                  nproc=args.nproc,
                   )
     md.produceMetadata(fullpath)
 
@@ -67,24 +76,44 @@ def update_metadata(args):
                   var_pos=d.var_pos,
                   n_pixels=d.n_pixels,
                   img_ranges=d.img_ranges,
+                  clip_range=d.clip_range,
+                  storage_types=d.storage_types,
+                  sort_by=d.sort_by,
+                  nproc=args.nproc,
                   )
     md.loadMetadata(os.path.join(args.outputdir, args.metadata))
+    md.setSelectionIndex(os.path.join(args.outputdir, SELECTION_INDEX_FILE))
+    if args.refresh:
+        md.refreshMetadata(os.path.join(args.outputdir, args.metadata), freeze_transform=args.freeze_transform)
     if args.remake_filelist:
         md.updateFilelist(args.test_sample)
     if args.remake_weights:
         md.updateWeights(args.test_sample)
+    md.numSelected()
+    md.saveSelectionIndex()
     md.writeMetadata(os.path.join(args.jobdir, args.metadata))
-    njobs = int(math.ceil(float(sum(md.num_events)) / args.events_per_file))
+    if os.path.exists(os.path.join(args.outputdir, SELECTION_INDEX_FILE)):
+        shutil.copy(os.path.join(args.outputdir, SELECTION_INDEX_FILE), os.path.join(args.jobdir, SELECTION_INDEX_FILE))
+    njobs = int(math.ceil(float(sum(md.num_selected)) / args.events_per_file))
     return md,njobs
 
+def plan_jobs(args, md):
+    plan = make_plan(md, args.events_per_file, n_streams=args.plan_streams)
+    write_plan(plan, os.path.join(args.jobdir, JOB_PLAN_FILE))
+    return plan, len(plan['jobs'])
+
 def submit(args):
     
     scriptfile = os.path.join(args.jobdir, 'runjob.sh')
     metadatafile = os.path.join(args.jobdir, args.metadata)
+    indexfile = os.path.join(args.jobdir, SELECTION_INDEX_FILE)
+    planfile = os.path.join(args.jobdir, JOB_PLAN_FILE)
 
     if not args.resubmit:
         from helper import xrd
         md, njobs = update_metadata(args)
+        if args.plan:
+            plan, njobs = plan_jobs(args, md)
 
         script = \
 '''#!/bin/bash
@@ -100,7 +129,7 @@ export PATH={conda_path}:$PATH
 source activate {conda_env_name}
 echo "LD_LIBRARY_PATH: $LD_LIBRARY_PATH"
 
-python {script} {outputdir} $jobid -n {events} {test_sample}
+python {script} {outputdir} $jobid -n {events} {test_sample} {writer_args} {plan}
 status=$?
 echo "Status = $status"
 ls -l
@@ -119,7 +148,9 @@ exit $status
            outputdir=args.outputdir,
            events=args.events_per_file,
            test_sample='--test-sample' if args.test_sample else '',
-           xrdcp='' if not args.outputdir.startswith('/eos') else 'xrdcp -np *.h5 %s ; rm *.h5' % (xrd(args.outputdir) + '/')
+           writer_args=writer_cmdline(args),
+           plan='--plan %s' % JOB_PLAN_FILE if args.plan else '',
+           xrdcp='' if not args.outputdir.startswith('/eos') else 'xrdcp -np *.h5 *{manifest} {dest} ; rm *.h5 *{manifest}'.format(manifest=MANIFEST_SUFFIX, dest=xrd(args.outputdir) + '/')
            )
 
         with open(scriptfile, 'w') as f:
@@ -130,27 +161,20 @@ exit $status
         jobids_file = os.path.join(args.jobdir, 'submit.txt')
 
     else:
-        # resubmit
+        # resubmit the jobs whose output is missing, stale or corrupt according to the completion manifests
+        md = Metadata(None)
+        md.loadMetadata(metadatafile)
+        plan = load_plan(planfile) if args.plan else None
+        with open(os.path.join(args.jobdir, 'submit.txt')) as f:
+            submitted = [int(jobid) for jobid in f.read().split()]
         jobids = []
         jobids_file = os.path.join(args.jobdir, 'resubmit.txt')
-        log_files = [f for f in os.listdir(args.jobdir) if f.endswith('.log')]
-        for fn in log_files:
-            with open(os.path.join(args.jobdir, fn)) as logfile:
-                errormsg = None
-                for line in reversed(logfile.readlines()):
-                    if 'Job removed' in line or 'aborted' in line:
-                        errormsg = line
-                    if 'Job submitted from host' in line:
-                        # if seeing this first: the job has been resubmited
-                        break
-                    if 'return value' in line:
-                        if 'return value 0' not in line:
-                            errormsg = line
-                        break
-                if errormsg:
-                    logging.debug(fn + '\n   ' + errormsg)
-                    jobids.append(fn.split('.')[0])
-                    assert jobids[-1].isdigit()
+        for jobid in submitted:
+            output = os.path.join(args.outputdir, output_name(jobid, args.test_sample))
+            if not is_complete(output, output_key(md, jobid, args.events_per_file, args.test_sample, plan, output_options(args.total_weight, args.group_vars, args.ragged, args.image_format))):
+                logging.debug('Job %d is not complete' % jobid)
+                jobids.append(str(jobid))
+        logging.info('%d out of %d jobs to be resubmitted' % (len(jobids), len(submitted)))
 
     with open(jobids_file, 'w') as f:
         f.write('\n'.join(jobids))
@@ -161,7 +185,7 @@ requirements          = (Arch == "X86_64") && (OpSys == "LINUX")
 request_disk          = 10000000
 executable            = {scriptfile}
 arguments             = $(jobid)
-transfer_input_files  = {metadatafile}
+transfer_input_files  = {metadatafile},{indexfile}{planfile}
 output                = {jobdir}/$(jobid).out
 error                 = {jobdir}/$(jobid).err
 log                   = {jobdir}/$(jobid).log
@@ -171,6 +195,8 @@ Should_Transfer_Files = YES
 queue jobid from {jobids_file}
 '''.format(scriptfile=os.path.abspath(scriptfile),
            metadatafile=os.path.abspath(metadatafile),
+           indexfile=os.path.abspath(indexfile),
+           planfile=',' + os.path.abspath(planfile) if args.plan else '',
            jobdir=os.path.abspath(args.jobdir),
            outputdir=args.outputdir,
            jobids_file=os.path.abspath(jobids_file)
@@ -183,15 +209,20 @@ queue jobid from {jobids_file}
 
 def run_all(args):
     md, njobs = update_metadata(args)
+    plan = None
+    if args.plan:
+        plan, njobs = plan_jobs(args, md)
 #     for jobid in range(njobs):
 #         writeData(md, args.outputdir, jobid, batch_mode=False,
 #                         test_sample=args.test_sample, events=args.events_per_file, dryrun=args.dryrun)
-    pool = multiprocessing.Pool(args.nproc)
-    pool.map(
-        functools.partial(writeData, md, args.outputdir, batch_mode=False,
-                          test_sample=args.test_sample, events=args.events_per_file, dryrun=args.dryrun),
-        range(njobs)
-        )
+    convert = functools.partial(get_writer(args), md, args.outputdir, batch_mode=False,
+                                test_sample=args.test_sample, events=args.events_per_file, dryrun=args.dryrun, plan=plan)
+    failed = run_jobs(convert, range(njobs), args.nproc, memory_budget=args.memory_budget, max_retries=args.max_retries,
+                      progress_file=os.path.join(args.jobdir, 'progress.json'))
+    if failed:
+        logging.error('Failed jobs: %s' % ','.join(str(jobid) for jobid in failed))
+    if not args.dryrun:
+        update_catalog(args.outputdir)
 
 def main():
     parser = argparse.ArgumentParser('Preprocess ntuples')
@@ -215,7 +246,7 @@ def main():
         )
     parser.add_argument('--resubmit',
         action='store_true', default=False,
-        help='Resubmit failed jobs. Default: %(default)s'
+        help='Resubmit the jobs without a complete and valid output (use the same options as for the submission). Default: %(default)s'
     )
     parser.add_argument('-j', '--jobdir',
         default='jobs',
@@ -223,7 +254,15 @@ def main():
         )
     parser.add_argument('--nproc',
         type=int, default=8,
-        help='Number of jobs to run in parallel. Default: %(default)s'
+        help='Number of jobs to run in parallel, also used for reading the input files when producing the metadata. Default: %(default)s'
+    )
+    parser.add_argument('--memory-budget',
+        type=float, default=None,
+        help='Memory budget in MB for the jobs running in parallel locally; new jobs are held back if it would be exceeded. Default: %(default)s'
+    )
+    parser.add_argument('--max-retries',
+        type=int, default=2,
+        help='Number of retries of failed jobs when running locally. Default: %(default)s'
     )
     parser.add_argument('-n', '--events-per-file',
         type=int, default=50000,
@@ -233,6 +272,15 @@ def main():
         action='store_true', default=False,
         help='Convert test data. Default: %(default)s'
     )
+    add_writer_args(parser)
+    parser.add_argument('--plan',
+        action='store_true', default=False,
+        help='Assign each job contiguous ranges of entries from a few input files, and write the plan to the job dir. Default: %(default)s'
+    )
+    parser.add_argument('--plan-streams',
+        type=int, default=4,
+        help='Number of input files read in parallel by each job when using --plan. Default: %(default)s'
+    )
     parser.add_argument('--remake-filelist',
         action='store_true', default=False,
         help='Remake filelist. Default: %(default)s'
@@ -241,6 +289,14 @@ def main():
         action='store_true', default=False,
         help='Remake reweighting weights. Default: %(default)s'
     )
+    parser.add_argument('--refresh',
+        action='store_true', default=False,
+        help='Update the file list, weights and transformation info of the metadata, only reading the new or modified input files. Default: %(default)s'
+    )
+    parser.add_argument('--freeze-transform',
+        action='store_true', default=False,
+        help='With --refresh, keep the variables and transformation info unchanged, so that previously converted files remain compatible. Default: %(default)s'
+    )
     parser.add_argument('--conda-path',
         default='~/miniconda2/bin',
         help='Conda bin path. Default: %(default)s'
@@ -266,6 +322,7 @@ def main():
         os.makedirs(args.outputdir)
 
     if args.submittype == 'interactive':
+        setup_staging(args)
         run_all(args)
     elif args.submittype == 'condor':
         submit(args)
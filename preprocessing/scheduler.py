@@ -0,0 +1,115 @@
+'''
+Local scheduler for the conversion jobs.
+
+Each job runs in its own forked process, so the metadata (and everything else
+bound to the job function) is shared with the workers through fork instead of
+being pickled into every task, and the memory is returned after each job.
+Jobs are pulled dynamically from a queue: a new job is started only if fewer
+than `nproc` jobs are running and, if a memory budget is given, the current RSS
+of the running jobs plus the largest RSS seen so far for one job fits in the
+budget. Failed jobs are retried, and a progress summary is written to a json
+file while running.
+
+@author: hqu
+'''
+
+import os
+import json
+import time
+import logging
+import multiprocessing
+
+def _rss_mb(pid):
+    ''' Resident memory of a process in MB, read from /proc (0 if not available). '''
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return 0.
+
+class _Job(object):
+
+    def __init__(self, jobid, process):
+        self.jobid = jobid
+        self.process = process
+        self.start_time = time.time()
+        self.peak_rss = 0.
+
+def _write_progress(progress_file, summary):
+    tmpfile = progress_file + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    os.rename(tmpfile, progress_file)
+
+def run_jobs(func, jobids, nproc, memory_budget=None, max_retries=2, progress_file=None, poll_interval=1.):
+    ''' Run `func(jobid)` for each job, at most `nproc` at a time and within `memory_budget` (MB) if given.
+        Returns the list of jobs that failed after all the retries. '''
+    pending = list(jobids)
+    running = []
+    done = []
+    failed = []
+    trials = dict((jobid, 0) for jobid in pending)
+    max_job_rss = 0.  # largest RSS seen for a single job
+    durations = []
+    start_time = time.time()
+    last_report = 0
+
+    while pending or running:
+        # update the running jobs
+        for job in list(running):
+            if job.process.is_alive():
+                job.peak_rss = max(job.peak_rss, _rss_mb(job.process.pid))
+                continue
+            job.process.join()
+            running.remove(job)
+            max_job_rss = max(max_job_rss, job.peak_rss)
+            if job.process.exitcode == 0:
+                done.append(job.jobid)
+                durations.append(time.time() - job.start_time)
+                logging.info('Job %s done in %.0f s, peak RSS %.0f MB' % (job.jobid, durations[-1], job.peak_rss))
+            elif trials[job.jobid] <= max_retries:
+                logging.warning('Job %s failed with exit code %s, will retry' % (job.jobid, job.process.exitcode))
+                pending.append(job.jobid)
+            else:
+                logging.error('Job %s failed with exit code %s after %d trials' % (job.jobid, job.process.exitcode, trials[job.jobid]))
+                failed.append(job.jobid)
+
+        # start new jobs
+        while pending and len(running) < nproc:
+            if memory_budget and running:
+                used = sum(_rss_mb(job.process.pid) for job in running)
+                expected = max([max_job_rss] + [job.peak_rss for job in running])
+                if used + expected > memory_budget:
+                    break
+            jobid = pending.pop(0)
+            trials[jobid] += 1
+            process = multiprocessing.Process(target=func, args=(jobid,))
+            process.start()
+            running.append(_Job(jobid, process))
+
+        now = time.time()
+        if progress_file and (now - last_report > 10 * poll_interval or not (pending or running)):
+            last_report = now
+            elapsed = now - start_time
+            _write_progress(progress_file, {
+                'total': len(trials),
+                'done': len(done),
+                'failed': failed,
+                'running': [job.jobid for job in running],
+                'pending': len(pending),
+                'retries': sum(max(n - 1, 0) for n in trials.values()),
+                'elapsed_s': round(elapsed, 1),
+                'jobs_per_hour': round(len(done) / elapsed * 3600., 2) if elapsed > 0 else 0,
+                'mean_job_s': round(sum(durations) / len(durations), 1) if durations else None,
+                'rss_mb': round(sum(_rss_mb(job.process.pid) for job in running), 1),
+                'max_job_rss_mb': round(max_job_rss, 1),
+                'memory_budget_mb': memory_budget,
+                })
+        if pending or running:
+            time.sleep(poll_interval)
+
+    logging.info('%d jobs done, %d failed, in %.0f s' % (len(done), len(failed), time.time() - start_time))
+    return failed
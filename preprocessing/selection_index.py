@@ -0,0 +1,120 @@
+'''
+Persistent index of the input files: number of entries and entries passing the selection.
+
+The index is stored as a npz file next to the metadata file. For each input file
+it keeps a bit mask of the passing entries, together with the file size, mtime
+and the selection string used to produce it. Entries are recomputed only if any
+of these has changed.
+
+@author: hqu
+'''
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+from helper import get_num_events, get_selected_entries
+
+SELECTION_INDEX_FILE = 'selection_index.npz'
+
+def _file_stat(filepath):
+    try:
+        st = os.stat(filepath)
+        return st.st_size, int(st.st_mtime)
+    except OSError:
+        # e.g., remote files not visible from the batch nodes
+        return None, None
+
+class SelectionIndex(object):
+
+    ''' Passing entry numbers per input file, keyed by path, size, mtime and selection. '''
+
+    def __init__(self, filepath, treename, selection):
+        self.filepath = filepath
+        self.treename = treename
+        self.selection = selection
+        self._header = {}  # {path: {'size', 'mtime', 'selection', 'num_entries', 'num_selected', 'key'}}
+        self._masks = {}  # {key: packed bit mask}, new or loaded entries
+        self._npz = None
+        self._modified = False
+        if filepath and os.path.exists(filepath):
+            self._load()
+
+    def __getstate__(self):
+        # do not pickle the open npz file
+        state = self.__dict__.copy()
+        state['_npz'] = None
+        return state
+
+    def _load(self):
+        self._npz = np.load(self.filepath)
+        self._header = json.loads(str(self._npz['header']))
+        logging.info('Selection index loaded from %s (%d files)' % (self.filepath, len(self._header)))
+
+    def _get_mask(self, key):
+        if key not in self._masks:
+            if self._npz is None:
+                self._npz = np.load(self.filepath)
+            self._masks[key] = self._npz[key]
+        return self._masks[key]
+
+    def _is_valid(self, fn):
+        info = self._header.get(fn)
+        if info is None or info['selection'] != self.selection:
+            return False
+        size, mtime = _file_stat(fn)
+        if size is None:
+            # cannot check, trust the index
+            return True
+        return info['size'] == size and info['mtime'] == mtime
+
+    def update(self, fn, entries, num_entries):
+        ''' Store the passing entries of a file. '''
+        mask = np.zeros(num_entries, dtype=bool)
+        mask[entries] = True
+        size, mtime = _file_stat(fn)
+        key = 'f' + hashlib.sha1(fn.encode('utf-8')).hexdigest()[:16]
+        self._header[fn] = {'size': size, 'mtime': mtime, 'selection': self.selection,
+                            'num_entries': int(num_entries), 'num_selected': int(len(entries)), 'key': key}
+        self._masks[key] = np.packbits(mask)
+        self._modified = True
+
+    def entries(self, fn, filepath=None, num_entries=None):
+        ''' Passing entry numbers of file `fn` (as listed in the metadata).
+            They are computed (reading from `filepath` if given, e.g., the xrootd url) and cached if not available. '''
+        if not self._is_valid(fn):
+            if num_entries is None:
+                num_entries = get_num_events(filepath or fn, self.treename)
+            entries = get_selected_entries(filepath or fn, self.treename, self.selection, 0, num_entries)
+            self.update(fn, entries, num_entries)
+            return entries
+        info = self._header[fn]
+        mask = np.unpackbits(self._get_mask(info['key']))[:info['num_entries']]
+        return np.flatnonzero(mask)
+
+    def num_selected(self, fn):
+        ''' Number of passing entries of file `fn`, or None if not indexed. '''
+        if not self._is_valid(fn):
+            return None
+        return self._header[fn]['num_selected']
+
+    def num_entries(self, fn):
+        ''' Total number of entries of file `fn`, or None if not indexed. '''
+        if not self._is_valid(fn):
+            return None
+        return self._header[fn]['num_entries']
+
+    def save(self):
+        if not self.filepath or not self._modified:
+            return
+        # keep only the files still present in the header
+        arrays = {info['key']: self._get_mask(info['key']) for info in self._header.values()}
+        tmpfile = self.filepath + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, header=json.dumps(self._header, sort_keys=True), **arrays)
+        os.rename(tmpfile, self.filepath)
+        self._npz = None
+        self._modified = False
+        logging.info('Selection index written to %s (%d files)' % (self.filepath, len(self._header)))
@@ -0,0 +1,231 @@
+'''
+Global shuffle of converted files, with bounded memory.
+
+Two-pass bucket shuffle:
+ 1) scatter: each input file is read in chunks, and every row is assigned to
+    one of N buckets at random. The rows of each chunk are written, grouped by
+    bucket, to a temporary file per input file.
+ 2) gather: for each bucket, its rows are collected from all temporary files,
+    shuffled in memory and written to one output file.
+The memory usage is bounded by the chunk size in the first pass and by the size
+of one bucket (i.e., one output file) in the second pass. Both passes run in
+parallel over processes.
+
+@author: hqu
+'''
+
+from __future__ import print_function
+
+import os
+import glob
+import shutil
+import argparse
+import logging
+import functools
+import multiprocessing
+import numpy as np
+
+from catalog import update_catalog
+
+import tables
+filters = tables.Filters(complevel=7, complib='blosc')
+
+def _leaves(h5file):
+    return [node for node in h5file.walk_nodes('/', 'Leaf')]
+
+def _copy_attrs(src, dst):
+    for k in src.attrs._v_attrnamesuser:
+        dst.attrs[k] = src.attrs[k]
+
+def _offset_groups(h5file):
+    ''' Datasets stored without padding, {offsets name: [value names]}: the values of all the rows are concatenated along
+        the last axis of the value datasets (e.g., `ragged_<name>` (C, N), `img_pixels` (N,)), and `<base>_offsets` holds
+        the start of each row in them. '''
+    groups = {}
+    for node in h5file.root:
+        if not node._v_name.endswith('_offsets') or node._v_name.startswith('_'):
+            continue
+        base = node._v_name[:-len('_offsets')]
+        values = [name for name in (base, base + '_pixels', base + '_values', base + '_particles') if name in h5file.root]
+        if values:
+            groups[node._v_name] = values
+    return groups
+
+def _ranges(starts, lengths):
+    ''' Positions of the values of rows given by their `starts` and `lengths`, row after row. '''
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+
+def _scatter(args, ifile):
+    ''' Pass 1: write the rows of one input file grouped by bucket, chunk by chunk.
+        For the datasets stored without padding, the values are moved with their rows, and the offsets are replaced by
+        the row lengths in the temporary file. '''
+    inputfile = args.inputfiles[ifile]
+    tmpfile = os.path.join(args.tmpdir, 'scatter_%d.h5' % ifile)
+    rng = np.random.RandomState(args.seed + ifile)
+    with tables.open_file(inputfile) as fin, tables.open_file(tmpfile, mode='w') as fout:
+        groups = _offset_groups(fin)
+        value_names = set(name for values in groups.values() for name in values)
+        leaves = [node for node in _leaves(fin) if node.name not in value_names]
+        nrows = leaves[0].shape[0]
+        for node in leaves:
+            if node.shape[0] != nrows:
+                raise RuntimeError('Dataset %s in %s has %d rows, expected %d' % (node._v_pathname, inputfile, node.shape[0], nrows))
+
+        def _append(node, a, expectedrows, values=False):
+            try:
+                arr = fout.get_node('/', node.name)
+            except tables.NoSuchNodeError:
+                shape = a.shape[:-1] + (0,) if values else (0,) + a.shape[1:]
+                arr = fout.create_earray('/', node.name, atom=tables.Atom.from_dtype(a.dtype), shape=shape,
+                                         title=node.title, filters=filters, expectedrows=expectedrows)
+                _copy_attrs(node, arr)
+            arr.append(a)
+            return arr
+
+        offsets = []
+        value_offsets = dict((name, []) for name in groups)
+        for start in range(0, nrows, args.chunk_size):
+            stop = min(start + args.chunk_size, nrows)
+            buckets = rng.randint(args.nbuckets, size=stop - start)
+            order = np.argsort(buckets, kind='mergesort')
+            bounds = np.searchsorted(buckets[order], np.arange(args.nbuckets + 1))
+            offsets.append(start + bounds)
+            lengths = {}
+            for name, values in groups.items():
+                n_values = fin.get_node('/', values[0]).shape[-1]
+                row_starts = fin.get_node('/', name)[start:stop]
+                end = fin.get_node('/', name)[stop] if stop < nrows else n_values
+                lengths[name] = np.diff(np.append(row_starts, end))
+                first = row_starts[0] if len(row_starts) else end
+                index = _ranges(row_starts[order] - first, lengths[name][order])
+                for v_name in values:
+                    node = fin.get_node('/', v_name)
+                    arr = _append(node, node[..., first:end].take(index, axis=-1), max(n_values, 1), values=True)
+                base = arr.shape[-1] - len(index)
+                value_offsets[name].append(base + np.append(0, np.cumsum(lengths[name][order]))[bounds])
+            for node in leaves:
+                a = lengths[node.name] if node.name in groups else node[start:stop]
+                _append(node, a[order], nrows)
+        fout.create_array('/', '_bucket_offsets', obj=np.array(offsets, dtype=np.int64).reshape((-1, args.nbuckets + 1)))
+        for name in groups:
+            fout.create_array('/', '_values_' + name, obj=np.array(value_offsets[name], dtype=np.int64).reshape((-1, args.nbuckets + 1)))
+    logging.info('Scattered %s (%d rows)' % (inputfile, nrows))
+    return tmpfile
+
+def _gather(args, tmpfiles, bucket):
+    ''' Pass 2: collect the rows of one bucket, shuffle them and write the output file. '''
+    rng = np.random.RandomState(args.seed + len(args.inputfiles) + bucket)
+    pieces = {}
+    titles = {}
+    groups = {}
+    for tmpfile in tmpfiles:
+        with tables.open_file(tmpfile) as f:
+            offsets = f.root._bucket_offsets[:]
+            groups = _offset_groups(f)
+            value_offsets = dict((v_name, f.get_node('/', '_values_' + name)[:]) for name in groups for v_name in groups[name])
+            for node in _leaves(f):
+                if node.name.startswith('_'):
+                    continue
+                if node.name not in titles:
+                    titles[node.name] = (node.title, {k: node.attrs[k] for k in node.attrs._v_attrnamesuser})
+                if node.name in value_offsets:
+                    pieces.setdefault(node.name, []).extend(node[..., begin:end] for begin, end in value_offsets[node.name][:, bucket:bucket + 2])
+                else:
+                    pieces.setdefault(node.name, []).extend(node[begin:end] for begin, end in offsets[:, bucket:bucket + 2])
+    data = {name: np.concatenate(pieces[name], axis=-1 if name in value_offsets else 0) for name in pieces}
+    row_names = [name for name in data if name not in value_offsets]
+    nrows = len(data[row_names[0]]) if row_names else 0
+    if nrows == 0:
+        return 0
+    perm = rng.permutation(nrows)
+    out = dict((name, data[name][perm]) for name in row_names)
+    for name in groups:
+        # move the values with their rows, and turn the row lengths back into offsets
+        lengths = data[name]
+        index = _ranges((np.cumsum(lengths) - lengths)[perm], lengths[perm])
+        for v_name in groups[name]:
+            out[v_name] = data[v_name].take(index, axis=-1)
+        out[name] = np.cumsum(out[name]) - out[name]
+    output = os.path.join(args.outputdir, '%s_file_%d.h5' % (args.output_prefix, bucket))
+    output_tmp = output + '.tmp'
+    with tables.open_file(output_tmp, mode='w') as fout:
+        for name in sorted(out):
+            title, attrs = titles[name]
+            arr = fout.create_carray('/', name, obj=out[name], title=title, filters=filters)
+            for k in attrs:
+                arr.attrs[k] = attrs[k]
+    os.rename(output_tmp, output)
+    logging.info('Written %s (%d rows)' % (output, nrows))
+    return nrows
+
+def shuffle_files(args):
+    args.inputfiles = sorted(glob.glob(os.path.join(args.inputdir, args.pattern)))
+    if not args.inputfiles:
+        raise RuntimeError('No input files matching %s in %s' % (args.pattern, args.inputdir))
+    if args.nbuckets <= 0:
+        args.nbuckets = len(args.inputfiles)
+    if not os.path.exists(args.outputdir):
+        os.makedirs(args.outputdir)
+    if not args.tmpdir:
+        args.tmpdir = os.path.join(args.outputdir, '_shuffle_tmp')
+    if not os.path.exists(args.tmpdir):
+        os.makedirs(args.tmpdir)
+    logging.info('Shuffling %d files into %d buckets' % (len(args.inputfiles), args.nbuckets))
+
+    pool = multiprocessing.Pool(args.nproc)
+    try:
+        tmpfiles = pool.map(functools.partial(_scatter, args), range(len(args.inputfiles)))
+        nrows = pool.map(functools.partial(_gather, args, tmpfiles), range(args.nbuckets))
+    finally:
+        pool.close()
+        pool.join()
+    shutil.rmtree(args.tmpdir)
+
+    metadata = os.path.join(args.inputdir, 'metadata.json')
+    if os.path.exists(metadata) and os.path.abspath(args.inputdir) != os.path.abspath(args.outputdir):
+        shutil.copy(metadata, args.outputdir)
+    logging.info('Done! %d rows written to %d files' % (sum(nrows), sum(1 for n in nrows if n > 0)))
+
+def main():
+    parser = argparse.ArgumentParser('Shuffle converted files across files')
+    parser.add_argument('inputdir',
+        help='Input directory.'
+    )
+    parser.add_argument('outputdir',
+        help='Output directory.'
+    )
+    parser.add_argument('--pattern',
+        default='train_file_*.h5',
+        help='Pattern of the input files. Default: %(default)s'
+    )
+    parser.add_argument('--output-prefix',
+        default='train',
+        help='Prefix of the output files. Default: %(default)s'
+    )
+    parser.add_argument('--nbuckets',
+        type=int, default=-1,
+        help='Number of buckets, i.e., output files. Use the number of input files if not positive. Default: %(default)s'
+    )
+    parser.add_argument('--chunk-size',
+        type=int, default=50000,
+        help='Number of rows read at once in the first pass. Default: %(default)s'
+    )
+    parser.add_argument('--nproc',
+        type=int, default=8,
+        help='Number of processes to run in parallel. Default: %(default)s'
+    )
+    parser.add_argument('--tmpdir',
+        default=None,
+        help='Directory for the temporary files. Default: [outputdir]/_shuffle_tmp'
+    )
+    parser.add_argument('--seed',
+        type=int, default=42,
+        help='Random seed. Default: %(default)s'
+    )
+    args = parser.parse_args()
+    shuffle_files(args)
+    update_catalog(args.outputdir)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(levelname)s: %(message)s')
+    main()
@@ -0,0 +1,152 @@
+'''
+Mergeable streaming statistics for the variable transformation infos.
+
+`QuantileSketch` is a KLL-style quantile sketch: values are added chunk by chunk
+into a stack of compactors, and a full compactor keeps every other one of its
+sorted items and promotes them to the next level with twice the weight. The
+memory is bounded by O(k) items regardless of the number of values, and two
+sketches can be merged level by level. As long as no compaction happened the
+sketch holds all the values and the quantiles are exact (same as np.percentile).
+
+`VarStats` combines a quantile sketch with the min/max, mean/std and, for
+sequence-like variables, the histogram of the sequence lengths.
+
+@author: hqu
+'''
+
+import numpy as np
+
+class QuantileSketch(object):
+
+    ''' KLL-style mergeable quantile sketch. '''
+
+    def __init__(self, k=4096, seed=42):
+        self.k = k
+        self.count = 0
+        self._levels = [np.zeros(0, dtype=np.float64)]
+        self._rng = np.random.RandomState(seed)
+
+    def _capacity(self, level):
+        # lower levels get exponentially smaller capacities (factor 2/3), but at least 2 items
+        depth = len(self._levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2. / 3) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self._levels):
+            items = self._levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self._levels):
+                    self._levels.append(np.zeros(0, dtype=np.float64))
+                items = np.sort(items)
+                if len(items) % 2:
+                    # keep the odd item at this level
+                    self._levels[level], items = items[-1:], items[:-1]
+                else:
+                    self._levels[level] = items[:0]
+                promoted = items[self._rng.randint(2)::2]
+                self._levels[level + 1] = np.concatenate([self._levels[level + 1], promoted])
+            level += 1
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self._levels[0] = np.concatenate([self._levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        self.count += other.count
+        for level, items in enumerate(other._levels):
+            if level == len(self._levels):
+                self._levels.append(np.zeros(0, dtype=np.float64))
+            self._levels[level] = np.concatenate([self._levels[level], items])
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        ''' Quantile at `q` (in percent, as np.percentile). '''
+        if self.count == 0:
+            raise ValueError('Cannot get the quantile of an empty sketch')
+        if len(self._levels) == 1:
+            # nothing compacted yet: exact
+            return float(np.percentile(self._levels[0], q))
+        items = np.concatenate(self._levels)
+        weights = np.concatenate([np.full(len(a), 2 ** level, dtype=np.float64) for level, a in enumerate(self._levels)])
+        order = np.argsort(items, kind='mergesort')
+        cumw = np.cumsum(weights[order])
+        pos = np.searchsorted(cumw, q / 100. * cumw[-1], side='left')
+        return float(items[order][min(pos, len(items) - 1)])
+
+class VarStats(object):
+
+    ''' Streaming summary of a (scalar or sequence-like) variable: quantiles, min/max, mean/std and lengths. '''
+
+    def __init__(self, k=4096, seed=42):
+        self.sketch = QuantileSketch(k=k, seed=seed)
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.
+        self.m2 = 0.  # sum of squared deviations from the mean
+        self.lengths = np.zeros(0, dtype=np.int64)  # histogram of the sequence lengths
+
+    @property
+    def count(self):
+        return self.sketch.count
+
+    def _update_moments(self, n, mean, m2):
+        # Chan et al. parallel update
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+
+    def update(self, a):
+        ''' Add a chunk of a branch: a numeric array, or an object array of sequences. '''
+        if a.dtype == np.object_:
+            lengths = np.bincount(np.fromiter((len(row) for row in a), dtype=np.int64, count=len(a)))
+            self._add_lengths(lengths)
+            a = np.concatenate(a) if len(a) else np.zeros(0)
+        a = np.nan_to_num(a)
+        if len(a) == 0:
+            return
+        a = np.asarray(a, dtype=np.float64)
+        mean = a.mean()
+        self._update_moments(len(a), mean, np.square(a - mean).sum())
+        self.min = min(self.min, float(a.min()))
+        self.max = max(self.max, float(a.max()))
+        self.sketch.update(a)
+
+    def _add_lengths(self, lengths):
+        if len(lengths) > len(self.lengths):
+            lengths, self.lengths = self.lengths, lengths.copy()
+        self.lengths[:len(lengths)] += lengths
+
+    def merge(self, other):
+        if other.count:
+            self._update_moments(other.count, other.mean, other.m2)
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self.sketch.merge(other.sketch)
+        self._add_lengths(other.lengths)
+        return self
+
+    def length_percentile(self, q):
+        ''' Percentile of the sequence lengths, as np.percentile on the list of lengths. '''
+        cumsum = np.cumsum(self.lengths)
+        pos = q / 100. * (cumsum[-1] - 1)
+        lo = np.searchsorted(cumsum, np.floor(pos), side='right')
+        hi = np.searchsorted(cumsum, np.ceil(pos), side='right')
+        return lo + (hi - lo) * (pos - np.floor(pos))
+
+    def info(self, size=None):
+        return {
+            'size'  : size,
+            'median': self.sketch.quantile(50),
+            'upper' : self.sketch.quantile(84),
+            'min'   : float(self.min),
+            'max'   : float(self.max),
+            'mean'  : float(self.mean),
+            'std'   : float(np.sqrt(self.m2 / self.count)),
+            }
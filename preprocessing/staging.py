@@ -0,0 +1,235 @@
+'''
+Local staging cache for the input files.
+
+Input files (e.g., on EOS, read through xrootd) are copied to a local cache
+directory and read from there, so the same file is transferred only once even
+if it is read by several passes or jobs. The files of the current and of the
+next job are copied in background threads. Each copy is written to a temporary
+file, its size checked against the source, and then renamed, so only complete
+copies are used. The least recently used files (by mtime, updated at each use)
+are evicted to keep the cache below a disk quota.
+
+The cache directory can be shared by several processes (e.g., the jobs run in
+parallel by the local scheduler): each process records the files it needs in a
+pin file (`.pins/<pid>`), the pinned files of all the running processes are
+never evicted, and the copies and the evictions are serialized with a fixed set of
+lock files.
+Plain local paths can stand in for the remote ones, e.g., for testing offline.
+
+@author: hqu
+'''
+
+import os
+import errno
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+NUM_STAGE_LOCKS = 64  # lock files serializing the copies between processes
+
+def _remote_size(path):
+    ''' Size of the source file in bytes, or None if it cannot be determined. '''
+    if '://' not in path:
+        return os.path.getsize(path)
+    # root://host//path
+    try:
+        host, _, filepath = path.partition('://')[2].partition('/')
+        out = subprocess.check_output(['xrdfs', host, 'stat', filepath]).decode('utf-8')
+        for line in out.splitlines():
+            if line.strip().startswith('Size:'):
+                return int(line.split(':')[1])
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        pass
+    return None
+
+def _copy(src, dst):
+    if '://' in src:
+        subprocess.check_call(['xrdcp', '-f', '-s', src, dst])
+    else:
+        shutil.copyfile(src, dst)
+
+class _FileLock(object):
+    ''' Exclusive lock on a file, shared between processes (and between the threads of a process). '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._f = open(self.path, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class StagingCache(object):
+
+    ''' LRU cache of local copies of the input files, with background prefetching. '''
+
+    def __init__(self, cachedir, quota_gb=50, nthreads=2, max_retries=5):
+        self.cachedir = os.path.abspath(cachedir)
+        self.quota = int(quota_gb * 1024 ** 3)
+        self.nthreads = nthreads
+        self.max_retries = max_retries
+        self._pindir = os.path.join(self.cachedir, '.pins')
+        if not os.path.exists(self._pindir):
+            os.makedirs(self._pindir)
+        self._pid = None
+
+    def _init_process(self):
+        # threads and locks do not survive a fork: (re)create them in each process
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._inflight = {}  # {path: threading.Event}
+        self._queue = queue.Queue()
+        for _ in range(self.nthreads):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+
+    def _worker(self):
+        while True:
+            path = self._queue.get()
+            try:
+                self.fetch(path)
+            except Exception:
+                logging.warning('Prefetching %s failed, will retry when it is read' % path)
+
+    def local_path(self, path):
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16] + '_' + os.path.basename(path)
+        return os.path.join(self.cachedir, name)
+
+    def _stage_lock(self, path):
+        # a fixed set of lock files, shared by the files with the same hash, so that they are never left behind
+        return os.path.join(self.cachedir, '.stage%d.lock' % (int(hashlib.sha1(path.encode('utf-8')).hexdigest(), 16) % NUM_STAGE_LOCKS))
+
+    def prefetch(self, paths, upcoming=()):
+        ''' Pin the files of the current job (`paths`) and of the next one (`upcoming`), so that they are not evicted
+            (until the next call), and start copying them in the background, the current ones first. '''
+        self._init_process()
+        self._pin(list(paths) + list(upcoming))
+        for p in list(paths) + list(upcoming):
+            self._queue.put(p)
+
+    def _pin(self, paths):
+        pinfile = os.path.join(self._pindir, str(os.getpid()))
+        with _FileLock(os.path.join(self.cachedir, '.lock')):
+            with open(pinfile + '.tmp', 'w') as f:
+                f.write('\n'.join(self.local_path(p) for p in paths))
+            os.rename(pinfile + '.tmp', pinfile)
+
+    def _pinned(self):
+        ''' Files pinned by the running processes (the pin files of the finished ones are removed). '''
+        pinned = set()
+        for name in os.listdir(self._pindir):
+            pinfile = os.path.join(self._pindir, name)
+            if name.endswith('.tmp'):
+                continue
+            if not _is_running(int(name)):
+                os.remove(pinfile)
+                continue
+            with open(pinfile) as f:
+                pinned.update(line.strip() for line in f if line.strip())
+        return pinned
+
+    def fetch(self, path):
+        ''' Local path of a complete copy of `path`, copying it first if needed. '''
+        if os.path.abspath(path).startswith(self.cachedir + os.sep):
+            return path
+        self._init_process()
+        local = self.local_path(path)
+        while True:
+            with self._lock:
+                event = self._inflight.get(path)
+                if event is None:
+                    if os.path.exists(local):
+                        os.utime(local, None)  # mark as recently used
+                        return local
+                    event = self._inflight[path] = threading.Event()
+                    break
+            # being copied by another thread
+            event.wait()
+        try:
+            # another process may be copying the same file
+            with _FileLock(self._stage_lock(path)):
+                if not os.path.exists(local):
+                    self._stage(path, local)
+        finally:
+            with self._lock:
+                del self._inflight[path]
+            event.set()
+        return local
+
+    def _stage(self, path, local):
+        tmpfile = '%s.%d.%d.tmp' % (local, os.getpid(), threading.current_thread().ident)
+        for trial in range(self.max_retries):
+            try:
+                size = _remote_size(path)
+                self._evict(size or 0)
+                start = time.time()
+                _copy(path, tmpfile)
+                copied = os.path.getsize(tmpfile)
+                if size is not None and copied != size:
+                    raise IOError('Size mismatch: %d bytes copied, %d expected' % (copied, size))
+                os.rename(tmpfile, local)
+                logging.debug('Staged %s (%.1f MB in %.1f s)' % (path, copied / 1024. ** 2, time.time() - start))
+                return
+            except Exception as e:
+                logging.error('Error staging %s (trial %d): %s' % (path, trial + 1, str(e)))
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+                time.sleep(min(2 ** trial, 60))
+        raise RuntimeError('Cannot stage file %s' % path)
+
+    def invalidate(self, path):
+        ''' Remove the local copy of `path`, e.g., after a read error, so that it is copied again. '''
+        local = self.local_path(path)
+        if os.path.exists(local):
+            os.remove(local)
+
+    def _evict(self, need):
+        ''' Remove the least recently used files until `need` more bytes fit in the quota. '''
+        with _FileLock(os.path.join(self.cachedir, '.lock')):
+            files = []
+            for name in os.listdir(self.cachedir):
+                if name.startswith('.'):
+                    continue  # locks and pins
+                fullpath = os.path.join(self.cachedir, name)
+                try:
+                    st = os.stat(fullpath)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, fullpath))
+            total = sum(f[1] for f in files)
+            pinned = self._pinned()
+            for mtime, size, fullpath in sorted(files):
+                if total + need <= self.quota:
+                    break
+                if fullpath in pinned or fullpath.endswith('.tmp'):
+                    continue
+                try:
+                    os.remove(fullpath)
+                    total -= size
+                    logging.debug('Evicted %s from the staging cache' % fullpath)
+                except OSError:
+                    pass
+        if total + need > self.quota:
+            logging.warning('Staging cache over quota: %.1f GB used' % ((total + need) / 1024. ** 3))
@@ -0,0 +1,122 @@
+'''
+Persistent per-file accumulators used to produce the metadata.
+
+For each input file the store keeps the raw reweighting histograms and the
+streaming statistics of the training variables (see sketch.py), together with
+the file size, mtime and the selection string used to produce them. They are
+stored as a pickle file next to the metadata file, so that a refresh of the
+metadata only needs to read the new or modified input files and merge their
+accumulators with the stored ones.
+
+@author: hqu
+'''
+
+import os
+import logging
+import pickle
+
+from selection_index import _file_stat
+
+STATS_STORE_FILE = 'metadata_stats.pkl'
+
+class StatsStore(object):
+
+    ''' Per-file reweighting histograms and variable statistics, keyed by path, size, mtime and selection. '''
+
+    def __init__(self, filepath, selection):
+        self.filepath = filepath
+        self.selection = selection
+        self._files = {}  # {path: {'size', 'mtime', 'selection', 'hists', 'hists_entries', 'stats', 'stats_pending'}}
+        self._config = {}  # {'hists'/'stats': settings used to produce them}
+        self._modified = False
+        if filepath and os.path.exists(filepath):
+            with open(filepath, 'rb') as f:
+                content = pickle.load(f)
+            self._files, self._config = content['files'], content['config']
+            logging.info('Metadata stats loaded from %s (%d files)' % (filepath, len(self._files)))
+
+    def _get(self, fn):
+        info = self._files.get(fn)
+        if info is None or info['selection'] != self.selection:
+            return None
+        size, mtime = _file_stat(fn)
+        if size is not None and (info['size'] != size or info['mtime'] != mtime):
+            return None
+        return info
+
+    def add(self, fn):
+        ''' Record file `fn`, dropping any outdated accumulators. '''
+        info = self._get(fn)
+        if info is None:
+            size, mtime = _file_stat(fn)
+            info = self._files[fn] = {'size': size, 'mtime': mtime, 'selection': self.selection, 'hists': None, 'stats': None}
+            self._modified = True
+        return info
+
+    def has(self, fn):
+        ''' Whether file `fn` has been recorded and has not changed since. '''
+        return self._get(fn) is not None
+
+    def _set(self, fn, key, value):
+        self.add(fn)[key] = value
+        self._modified = True
+
+    def hists(self, fn):
+        ''' Raw reweighting histograms {label: counts} of file `fn`, or None if not available. '''
+        info = self._get(fn)
+        return info['hists'] if info else None
+
+    def set_hists(self, fn, hists, num_entries=None):
+        self._set(fn, 'hists', hists)
+        self._set(fn, 'hists_entries', num_entries)
+
+    def hists_entries(self, fn):
+        ''' Number of selected entries of file `fn` used to fill its histograms, or None if not known. '''
+        info = self._get(fn)
+        return info.get('hists_entries') if info else None
+
+    def stats(self, fn):
+        ''' Variable statistics {branch: VarStats} of file `fn`, or None if not available. '''
+        info = self._get(fn)
+        return info['stats'] if info else None
+
+    def set_stats(self, fn, stats):
+        self._set(fn, 'stats', stats)
+
+    def stats_pending(self, fn):
+        ''' Whether the statistics of file `fn` have not been merged into the transformation info yet
+            (e.g., added by a refresh with frozen transformation). '''
+        info = self._get(fn)
+        return bool(info and info.get('stats_pending'))
+
+    def set_stats_pending(self, fn, pending):
+        self._set(fn, 'stats_pending', pending)
+
+    def check_config(self, key, config):
+        ''' Drop the `hists` or `stats` of all the files if they were produced with different settings
+            (e.g., the binning or the list of variables has changed). '''
+        if self._config.get(key) != config:
+            if self._config.get(key) is not None:
+                logging.info('Settings changed, dropping the stored %s' % key)
+            for info in self._files.values():
+                info[key] = None
+            self._config[key] = config
+            self._modified = True
+
+    def prune(self, inputfiles):
+        ''' Keep only the files in `inputfiles`. '''
+        keep = set(inputfiles)
+        for fn in list(self._files):
+            if fn not in keep:
+                del self._files[fn]
+                self._modified = True
+
+    def save(self):
+        if not self.filepath or not self._modified:
+            return
+        tmpfile = self.filepath + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            pickle.dump({'files': self._files, 'config': self._config}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, self.filepath)
+        self._modified = False
+        logging.info('Metadata stats written to %s (%d files)' % (self.filepath, len(self._files)))
@@ -0,0 +1,273 @@
+'''
+Tests of the preprocessing pipeline on synthetic npz inputs, without ROOT.
+
+@author: hqu
+'''
+
+import os
+import argparse
+
+import numpy as np
+import pytest
+import tables
+
+from readers import NpzReader, RootReader, get_reader, write_npz
+from helper import read_entries
+from metadata import Metadata
+import converter
+
+N_FILES = 2
+PART_SIZE = 20
+
+def _make_inputs(inputdir, seed=1):
+    ''' Write synthetic ntuples: jet-level branches, a particle list and an SV list. '''
+    rng = np.random.RandomState(seed)
+    for ifile in range(N_FILES):
+        n = 300 + 50 * ifile
+        cls = rng.randint(0, 3, n)
+        c = {}
+        for i, name in enumerate(['Top', 'W', 'QCD']):
+            c['fj_is' + name] = (cls == i).astype(np.int32)
+            c['label_' + name] = (cls == i).astype(np.int32)
+        c['fj_pt'] = rng.uniform(200, 2500, n).astype(np.float32)
+        c['fj_sdmass'] = rng.uniform(0, 300, n).astype(np.float32)
+        c['event_no'] = np.arange(n, dtype=np.int64) + 100000 * ifile
+        c['jet_tightId'] = (rng.uniform(size=n) > 0.2).astype(np.int32)
+        n_parts = rng.poisson(15, n)
+        c['n_parts'] = n_parts.astype(np.float32)
+        c['part_ptrel'] = [rng.exponential(0.05, k).astype(np.float32) for k in n_parts]
+        c['part_etarel'] = [rng.normal(0, 0.4, k).astype(np.float32) for k in n_parts]
+        c['part_phirel'] = [rng.normal(0, 0.4, k).astype(np.float32) for k in n_parts]
+        c['part_charge'] = [rng.randint(-1, 2, k).astype(np.float32) for k in n_parts]
+        c['sv_mass'] = [rng.normal(size=k).astype(np.float32) for k in rng.poisson(2, n)]
+        subdir = os.path.join(inputdir, 'sub%d' % ifile)
+        os.makedirs(subdir)
+        write_npz(os.path.join(subdir, 'f%d.npz' % ifile), c)
+
+def _make_metadata(inputdir, outputdir, reweight_events=-1):
+    md = Metadata(inputdir=inputdir,
+                  treename='deepntuplizer/tree',
+                  reweight_events=reweight_events,
+                  reweight_bins=[list(range(200, 2051, 50)), [-10000, 10000]],
+                  metadata_events=-1,
+                  selection='jet_tightId',
+                  var_groups={'part': (('part_',), PART_SIZE), 'sv': (('sv_',), 5)},
+                  var_blacklist=['n_parts'],
+                  var_no_transform_branches=['event_no', 'fj_pt', 'fj_sdmass', 'n_parts'],
+                  label_list=['label_Top', 'label_W', 'label_QCD'],
+                  reweight_var=['fj_pt', 'fj_sdmass'],
+                  reweight_classes=['fj_isTop', 'fj_isW', 'fj_isQCD'],
+                  reweight_method='flat',
+                  var_img='part_ptrel',
+                  var_pos=['part_etarel', 'part_phirel'],
+                  n_pixels=8,
+                  img_ranges=[[-0.8, 0.8], [-0.8, 0.8]],
+                  )
+    md.produceMetadata(os.path.join(outputdir, 'metadata.json'))
+    return md
+
+@pytest.fixture(scope='module')
+def inputs(tmp_path_factory):
+    inputdir = str(tmp_path_factory.mktemp('inputs'))
+    _make_inputs(inputdir)
+    return inputdir
+
+@pytest.fixture(scope='module')
+def metadata(inputs, tmp_path_factory):
+    np.random.seed(3)
+    return _make_metadata(inputs, str(tmp_path_factory.mktemp('metadata')))
+
+def _raw(inputdir, branch):
+    ''' Branch of all the input files, for the selected entries, in file order. '''
+    pieces = []
+    for ifile in range(N_FILES):
+        filepath = os.path.join(inputdir, 'sub%d' % ifile, 'f%d.npz' % ifile)
+        reader = get_reader(filepath)
+        passed = reader.read(filepath, None, 'jet_tightId') > 0
+        pieces.append(reader.read(filepath, None, branch)[passed])
+    return np.concatenate(pieces)
+
+def test_get_reader():
+    assert isinstance(get_reader('/path/to/file.npz'), NpzReader)
+    assert isinstance(get_reader('/path/to/file.root'), RootReader)
+    assert isinstance(get_reader('root://eosuser.cern.ch//path/to/file'), RootReader)
+
+def test_npz_roundtrip(tmp_path):
+    filepath = str(tmp_path / 'f.npz')
+    jagged = [np.arange(k, dtype=np.float32) for k in (3, 0, 2)]
+    write_npz(filepath, {'a': np.array([1, 2, 3], dtype=np.int32), 'b': jagged})
+    reader = NpzReader()
+    assert reader.num_entries(filepath, None) == 3
+    assert sorted(reader.branches(filepath, None)) == ['a', 'b']
+    rec = reader.read(filepath, None, ['a', 'b'], start=1, stop=3)
+    assert list(rec['a']) == [2, 3]
+    assert [list(row) for row in rec['b']] == [[], [0, 1]]
+
+@pytest.mark.parametrize('expression, expected', [
+    ('a > 1 && b < 2', [False, False, True, False]),
+    ('a == 0 || b == 3', [True, False, False, True]),
+    ('!a', [True, False, False, False]),
+    ('!a == b', [True, False, False, False]),  # (!a) == b as in C, not !(a == b)
+    ('!(a == b)', [True, True, True, False]),
+    ('a != b', [True, True, True, False]),
+    ('!a == 1', [True, False, False, False]),
+    ('TMath::Abs(c) < 1 && !(a > 2)', [True, False, True, False]),
+    ('sqrt(a*a) + 1 >= 3', [False, False, True, True]),
+    ('a>1 & b<2', [False, False, True, False]),  # & and | bind looser than the comparisons as in C
+    ('(a>1)&&(b<2)', [False, False, True, False]),
+    ('a==0 | b==3 & a>0', [True, False, False, True]),
+    ('a>2 && b>2 | a<1', [False, False, False, True]),  # a>2 && (b>2 | a<1)
+    ('(a==1 || a==2) & !(b > 1)', [False, False, True, False]),
+    ('abs(c) < 1 && atan2(a, b) > 0', [False, False, True, False]),
+    ])
+def test_selection_evaluator(tmp_path, expression, expected):
+    filepath = str(tmp_path / 'f.npz')
+    write_npz(filepath, {'a': np.array([0, 1, 2, 3]), 'b': np.array([1, 2, 1, 3]), 'c': np.array([0.5, -2., -0.5, 1.5])})
+    result = NpzReader().evaluate(filepath, None, expression)
+    assert [bool(x) for x in result] == expected
+
+def test_single_logical_operators(tmp_path):
+    filepath = str(tmp_path / 'f.npz')
+    rng = np.random.RandomState(0)
+    write_npz(filepath, {'a': rng.randint(0, 4, 100), 'b': rng.randint(0, 4, 100)})
+    reader = NpzReader()
+    for single, double in [('a>1 & b<2', '(a>1)&&(b<2)'), ('a>1 | b<2', '(a>1)||(b<2)'), ('a>1 | b<2 & a<3', '(a>1)||((b<2)&&(a<3))')]:
+        np.testing.assert_array_equal(reader.evaluate(filepath, None, single), reader.evaluate(filepath, None, double))
+
+@pytest.mark.parametrize('max_span', [1, 3, 10, 100000])
+def test_read_entries(tmp_path, max_span):
+    filepath = str(tmp_path / 'f.npz')
+    write_npz(filepath, {'a': np.arange(50), 'b': [np.arange(k) for k in range(50)]})
+    entries = np.array([0, 1, 2, 7, 8, 30, 49])
+    rec = read_entries(filepath, None, ['a', 'b'], entries, max_span=max_span)
+    assert list(rec['a']) == list(entries)
+    assert [len(row) for row in rec['b']] == list(entries)
+    assert len(read_entries(filepath, None, ['a'], np.arange(50)[10:20], max_span=max_span)) == 10
+
+def test_writer_modes_exclusive():
+    parser = argparse.ArgumentParser()
+    converter.add_writer_args(parser)
+    with pytest.raises(SystemExit):
+        parser.parse_args(['--stream', '--low-mem'])
+
+def test_metadata(inputs, metadata):
+    assert sorted(os.path.basename(fn) for fn in metadata.inputfiles) == ['f0.npz', 'f1.npz']
+    assert sum(metadata.num_selected) == len(_raw(inputs, 'event_no'))
+    assert set(metadata.var_branches) == set(['part_ptrel', 'part_etarel', 'part_phirel', 'part_charge', 'sv_mass'])
+    assert metadata.branches_info['part_ptrel']['size'] == PART_SIZE
+    assert set(metadata.reweight_info) == set(['fj_isTop', 'fj_isW', 'fj_isQCD'])
+
+def test_skip_erroneous_file(tmp_path):
+    # a file failing the selection (here, a missing branch) is ignored, the others are kept
+    inputdir = str(tmp_path / 'inputs')
+    _make_inputs(inputdir)
+    write_npz(os.path.join(inputdir, 'sub0', 'bad.npz'), {'fj_pt': np.ones(10, dtype=np.float32)})
+    md = Metadata(inputdir=inputdir, treename='deepntuplizer/tree', selection='jet_tightId')
+    inputfiles, num_events = md.updateFilelist()
+    assert sorted(os.path.basename(fn) for fn in inputfiles) == ['f0.npz', 'f1.npz']
+
+def test_refresh_reweight_events(tmp_path, monkeypatch):
+    # histograms made before files are added are scaled to the current fraction of events, as in a run from scratch
+    hists = []
+    prepare = Metadata._prepare_reweight_info
+    monkeypatch.setattr(Metadata, '_prepare_reweight_info', lambda self, h: (hists.append(h), prepare(self, h))[1])
+    inputdir = str(tmp_path / 'inputs')
+    _make_inputs(inputdir)
+    later = str(tmp_path / 'later')
+    os.rename(os.path.join(inputdir, 'sub1'), later)
+    md = _make_metadata(inputdir, str(tmp_path), reweight_events=200)
+    os.rename(later, os.path.join(inputdir, 'sub1'))
+    md.refreshMetadata(str(tmp_path / 'metadata.json'))
+    os.makedirs(str(tmp_path / 'scratch'))
+    _make_metadata(inputdir, str(tmp_path / 'scratch'), reweight_events=200)
+    refreshed, scratch = hists[1], hists[2]
+    totals = [sum(np.sum(h[label]) for label in h) for h in (refreshed, scratch)]
+    assert totals[0] == pytest.approx(totals[1], abs=1)
+    for label in scratch:
+        assert np.sum(refreshed[label]) == pytest.approx(np.sum(scratch[label]), rel=0.2)
+
+def _convert(md, writer, outputdir, **kwargs):
+    os.makedirs(outputdir)
+    np.random.seed(5)
+    events = sum(md.num_selected)  # a single job
+    if writer == 'plain':
+        converter.writeData(md, outputdir, 0, events=events, **kwargs)
+    elif writer == 'stream':
+        converter.writeData_stream(md, outputdir, 0, events=events, chunk_size=100, **kwargs)
+    else:
+        converter.writeData_lowMem(md, outputdir, 0, events=events, column_group_size=2, **kwargs)
+    return os.path.join(outputdir, converter.output_name(0))
+
+def _by_event(filepath):
+    ''' Content of the output file, ordered by event number. '''
+    with tables.open_file(filepath) as f:
+        order = np.argsort(f.root.orig_event_no[:])
+        return dict((node._v_name, node[:][order]) for node in f.walk_nodes('/', 'Leaf'))
+
+@pytest.mark.parametrize('writer', ['plain', 'stream', 'lowmem'])
+def test_writers(inputs, metadata, tmp_path, writer):
+    output = _convert(metadata, writer, str(tmp_path / writer))
+    content = _by_event(output)
+    event_no = _raw(inputs, 'event_no')
+    n = len(event_no)
+    np.testing.assert_array_equal(content['orig_event_no'], np.sort(event_no))
+    assert content['label'].shape == (n, 3)
+    assert content['weight'].shape == (n,)
+    assert content['img'].shape == (n, 8, 8)
+
+    # sequence variables are standardized, truncated and padded (with the median, i.e., 0 after the transformation)
+    order = np.argsort(event_no)
+    raw = _raw(inputs, 'part_ptrel')[order]
+    info = metadata.branches_info['part_ptrel']
+    expected = np.zeros((n, PART_SIZE), dtype=np.float32)
+    for i, row in enumerate(raw):
+        row = row[:PART_SIZE]
+        expected[i, :len(row)] = (row - np.float32(info['median'])) / np.float32(info['upper'] - info['median'])
+    assert content['part_ptrel'].shape == (n, PART_SIZE)
+    np.testing.assert_allclose(content['part_ptrel'], expected, rtol=1e-5, atol=1e-6)
+
+    # the labels follow the input flags
+    labels = np.stack([_raw(inputs, 'label_' + name)[order] for name in ['Top', 'W', 'QCD']], axis=1)
+    np.testing.assert_array_equal(content['label'], labels)
+
+def test_writers_agree(metadata, tmp_path):
+    contents = [_by_event(_convert(metadata, writer, str(tmp_path / writer))) for writer in ['plain', 'stream', 'lowmem']]
+    for content in contents[1:]:
+        assert sorted(content) == sorted(contents[0])
+        for name in content:
+            np.testing.assert_array_equal(content[name], contents[0][name])
+
+@pytest.mark.parametrize('writer, name', [('plain', 'group_part'), ('lowmem', 'group_part'), ('plain', 'ragged_part')])
+def test_mixed_group_storage(metadata, tmp_path, writer, name):
+    # int8 flags and float16 features in the same group: stored as float16, the flags exactly
+    kwargs = {'group_vars': True} if name.startswith('group') else {'ragged': True}
+    reference = _convert(metadata, writer, str(tmp_path / 'float32'), **kwargs)
+    metadata.storage_types = [('part_charge$', 'int8'), ('(part|sv)_', 'float16')]
+    try:
+        output = _convert(metadata, writer, str(tmp_path / 'compact'), **kwargs)
+    finally:
+        metadata.storage_types = None
+    with tables.open_file(reference) as f:
+        expected = f.get_node('/', name)[:]
+    with tables.open_file(output) as f:
+        node = f.get_node('/', name)
+        assert node.dtype == np.float16
+        stored = node[:]
+        channels = node.title.split(',')
+        q_scale, q_offset = node.attrs['q_scale'], node.attrs['q_offset']
+    axis = 1 if name.startswith('group') else 0  # ragged: (C, N)
+    shape = [1] * stored.ndim
+    shape[axis] = -1
+    widened = stored.astype(np.float32) * q_scale.reshape(shape) + q_offset.reshape(shape)
+    c = channels.index('part_charge')
+    np.testing.assert_allclose(widened.take(c, axis=axis), expected.take(c, axis=axis), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(widened, expected, rtol=1e-3, atol=1e-3)
+
+def test_stream_chunks_mixed(metadata, tmp_path):
+    # every chunk holds events of all the input files
+    output = _convert(metadata, 'stream', str(tmp_path / 'stream'))
+    with tables.open_file(output) as f:
+        event_no = f.root.orig_event_no[:]
+    for start in range(0, len(event_no), 100):
+        files = set(event_no[start:start + 100] // 100000)
+        assert files == set(range(N_FILES))
@@ -1,5 +1,7 @@
 from __future__ import print_function
 
+import os
+import json
 import numpy as np
 import mxnet as mx
 import multiprocessing
@@ -8,6 +10,265 @@ import logging
 import tables
 tables.set_blosc_max_threads(4)
 
+CATALOG_FILE = 'catalog.json'  # written by preprocessing/catalog.py in the directory of the converted files
+_catalogs = {}  # {dirpath: (mtime, {filename: entry})}
+
+def _catalog_entry(filename):
+    ''' Entry of the file in the catalog of its directory (rows, class counts, weight sums, dataset shapes and dtypes),
+        or None if there is no catalog, or the file is not in it or has been modified since it was indexed. '''
+    dirpath = os.path.dirname(os.path.abspath(filename))
+    catalog_file = os.path.join(dirpath, CATALOG_FILE)
+    try:
+        mtime = os.path.getmtime(catalog_file)
+        if dirpath not in _catalogs or _catalogs[dirpath][0] != mtime:
+            with open(catalog_file) as f:
+                _catalogs[dirpath] = (mtime, json.load(f)['files'])
+        entry = _catalogs[dirpath][1].get(os.path.basename(filename))
+        st = os.stat(filename)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+        return None
+    return entry
+
+def _is_multichannel(node):
+    ''' Whether the node is a grouped (`group_<name>`) or ragged (`ragged_<name>`) dataset with the channel names in its title. '''
+    name = node._v_name
+    return name.startswith('group_') or (name.startswith('ragged_') and not name.endswith('_offsets'))
+
+def _sparse_image_node(f, v_name):
+    ''' Pixels (`<v_name>_pixels`) or particles (`<v_name>_particles`) node of a sparse image, or None. '''
+    if v_name + '_offsets' not in f.root:
+        return None
+    for suffix in ('_pixels', '_particles'):
+        if v_name + suffix in f.root:
+            return getattr(f.root, v_name + suffix)
+    return None
+
+def _locate(f, v_name):
+    ''' Node holding a variable, and its channel index if it is stored as a channel of a grouped or ragged dataset. '''
+    if v_name in f.root:
+        return getattr(f.root, v_name), None
+    node = _sparse_image_node(f, v_name)
+    if node is not None:
+        return node, None
+    for node in f.root:
+        if _is_multichannel(node):
+            channels = node.title.split(',')
+            if v_name in channels:
+                return node, channels.index(v_name)
+    raise tables.NoSuchNodeError('Variable %s not found' % v_name)
+
+def _is_clipped(f, v_names, var_min, var_max):
+    ''' Check if all the datasets have already been clipped to within [var_min, var_max] at conversion. '''
+    for v_name in v_names:
+        attrs = _locate(f, v_name)[0].attrs
+        if 'clip_min' not in attrs or attrs['clip_min'] < var_min or attrs['clip_max'] > var_max:
+            return False
+    return True
+
+def _is_sorted(f, v_names, sort_by):
+    ''' Check if all the datasets have already been sorted at conversion as requested by `sort_by` ({'var', 'descend'}). '''
+    for v_name in v_names:
+        attrs = _locate(f, v_name)[0].attrs
+        if 'sorted_by' not in attrs or attrs['sorted_by'] != sort_by['var'] or bool(attrs['sort_descend']) != bool(sort_by['descend']):
+            return False
+    return True
+
+def _widen(node, a, channels=None):
+    ''' Widen the compact storage types (float16, integers, quantized) written by the converter.
+        `channels` are the channel indices of `a` for a grouped dataset. '''
+    attrs = node.attrs
+    if 'orig_dtype' in attrs:
+        a = a.astype(attrs['orig_dtype'])
+        if 'q_scale' in attrs:
+            q_scale, q_offset = attrs['q_scale'], attrs['q_offset']
+            if np.ndim(q_scale):
+                # per-channel factors of a grouped dataset
+                q_scale, q_offset = q_scale[channels], q_offset[channels]
+                if np.ndim(q_scale):
+                    shape = (1, -1) + (1,) * (a.ndim - 2)
+                    q_scale, q_offset = q_scale.reshape(shape), q_offset.reshape(shape)
+            a *= q_scale
+            a += q_offset
+    return a
+
+def _var_shape(f, v_name, n_pixels=None):
+    ''' Shape (n, ...) of a variable; `n_pixels` sets the resolution of an image stored as particles. '''
+    node = _sparse_image_node(f, v_name)
+    if node is not None:
+        if not node._v_name.endswith('_particles') or not n_pixels:
+            n_pixels = int(node.attrs['n_pixels'])
+        return (getattr(f.root, v_name + '_offsets').shape[0], n_pixels, n_pixels)
+    node, channel = _locate(f, v_name)
+    if channel is None:
+        return node.shape
+    if node._v_name.startswith('ragged_'):
+        return (getattr(f.root, node._v_name + '_offsets').shape[0], int(node.attrs['width']))
+    return node.shape[:1] + node.shape[2:]
+
+class _RaggedFetch(object):
+    ''' Rows of a ragged group: the flat values (N, C), and the start and length of each row in them.
+        Indexing selects rows without moving the values; `dense` pads the rows to (n, C, W). '''
+
+    def __init__(self, values, starts, lengths, width, pad_values, shape=None):
+        self.values = values
+        self.starts = starts
+        self.lengths = lengths
+        self.width = width
+        self.pad_values = pad_values
+        self.shape = shape  # reshape the dense array to this shape if given
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        return _RaggedFetch(self.values, self.starts[index], self.lengths[index], self.width, self.pad_values, self.shape)
+
+    def clip(self, var_min, var_max):
+        np.clip(self.values, var_min, var_max, out=self.values)
+        np.clip(self.pad_values, var_min, var_max, out=self.pad_values)
+
+    def dense(self):
+        x = np.empty((len(self.starts), self.width, self.values.shape[1]), dtype=self.values.dtype)
+        x[:] = self.pad_values
+        cols = np.arange(self.width)
+        mask = cols < self.lengths[:, np.newaxis]
+        x[mask] = self.values[(self.starts[:, np.newaxis] + cols)[mask]]
+        x = x.transpose((0, 2, 1))
+        return x.reshape(self.shape) if self.shape else np.ascontiguousarray(x)
+
+def _read_ragged(f, v_names, start=None, stop=None):
+    ''' Read the variables as a `_RaggedFetch` if they are all stored in the same ragged dataset, otherwise return None. '''
+    for node in f.root:
+        if not (node._v_name.startswith('ragged_') and _is_multichannel(node)):
+            continue
+        channels = node.title.split(',')
+        if all(v in channels for v in v_names):
+            indices = [channels.index(v) for v in v_names]
+            offsets = getattr(f.root, node._v_name + '_offsets')
+            starts = offsets[start:stop]
+            end = offsets[stop] if stop is not None and stop < offsets.shape[0] else node.shape[1]
+            first = starts[0] if len(starts) else end
+            values = node[:, first:end].T  # stored channel-major (C, N)
+            if indices != list(range(len(channels))):
+                values = values[:, indices]
+            values = _widen(node, values, indices)
+            if values.dtype != np.float32:
+                values = values.astype(np.float32)
+            lengths = np.diff(np.append(starts, end))
+            pad_values = node.attrs['pad_values'][indices].astype(np.float32)
+            return _RaggedFetch(values, starts - first, lengths, int(node.attrs['width']), pad_values)
+    return None
+
+def _pixel_indices(values, n_pixels, value_range):
+    ''' Bin indices as in `np.histogram2d` with `range` (-1 outside the range), same as the converter. '''
+    edges = np.linspace(value_range[0], value_range[1], n_pixels + 1)
+    idx = np.searchsorted(edges, values, side='right') - 1
+    idx[values == edges[-1]] -= 1
+    idx[(idx < 0) | (idx >= n_pixels)] = -1
+    return idx
+
+class _SparseImages(object):
+    ''' Rows of a sparse image: the flat pixel index and intensity of the entries of all the rows, and the start and
+        length of each row in them. Indexing selects rows without moving the entries; `dense` builds the images. '''
+
+    def __init__(self, pixels, values, starts, lengths, n_pixels, shape=None, clip_range=None):
+        self.pixels = pixels
+        self.values = values
+        self.starts = starts
+        self.lengths = lengths
+        self.n_pixels = n_pixels
+        self.shape = shape  # reshape the dense array to this shape if given
+        self.clip_range = clip_range
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        return _SparseImages(self.pixels, self.values, self.starts[index], self.lengths[index], self.n_pixels, self.shape, self.clip_range)
+
+    def clip(self, var_min, var_max):
+        # applied to the pixel sums when making the images
+        self.clip_range = (var_min, var_max)
+
+    def dense(self):
+        n = len(self.starts)
+        n_pix = self.n_pixels * self.n_pixels
+        rows = np.repeat(np.arange(n), self.lengths)
+        src = np.repeat(self.starts - np.cumsum(self.lengths) + self.lengths, self.lengths) + np.arange(len(rows))
+        x = np.bincount(rows * n_pix + self.pixels[src], weights=self.values[src], minlength=n * n_pix).astype(np.float32)
+        x = x.reshape((n, self.n_pixels, self.n_pixels))
+        if self.clip_range is not None:
+            np.clip(x, self.clip_range[0], self.clip_range[1], out=x)
+        return x.reshape(self.shape) if self.shape else x
+
+def _read_image(f, v_name, start=None, stop=None, n_pixels=None):
+    ''' Read a sparse image as `_SparseImages`, or return None if it is not stored as such. An image stored as particles
+        is binned here, at the resolution `n_pixels` if given (otherwise the one used at conversion). '''
+    node = _sparse_image_node(f, v_name)
+    if node is None:
+        return None
+    offsets = getattr(f.root, v_name + '_offsets')
+    starts = offsets[start:stop]
+    particles = node._v_name.endswith('_particles')
+    n_entries = node.shape[1] if particles else node.shape[0]
+    end = offsets[stop] if stop is not None and stop < offsets.shape[0] else n_entries
+    first = starts[0] if len(starts) else end
+    if particles:
+        x, y, values = node[:, first:end]
+        n_pixels = n_pixels or int(node.attrs['n_pixels'])
+        img_ranges = node.attrs['img_ranges']
+        ix = _pixel_indices(x, n_pixels, img_ranges[0])
+        iy = _pixel_indices(y, n_pixels, img_ranges[1])
+        outside = (ix < 0) | (iy < 0)
+        pixels = ix * n_pixels + iy
+        pixels[outside] = 0
+        values = np.where(outside, 0, values)
+    else:
+        n_pixels = int(node.attrs['n_pixels'])
+        pixels = node[first:end]
+        values = getattr(f.root, v_name + '_values')[first:end]
+    lengths = np.diff(np.append(starts, end))
+    return _SparseImages(pixels, values, starts - first, lengths, n_pixels)
+
+def _read_var(f, v_name, start=None, stop=None):
+    ''' Read a variable, from its own dataset or from its channel of a grouped or ragged dataset. '''
+    node, channel = _locate(f, v_name)
+    if _sparse_image_node(f, v_name) is not None:
+        return _read_image(f, v_name, start, stop).dense()
+    if node._v_name.startswith('ragged_'):
+        return _read_ragged(f, [v_name], start, stop).dense()[:, 0]
+    if channel is None:
+        return _widen(node, node[start:stop])
+    return _widen(node, node[start:stop, channel], channel)
+
+def _read_group(f, v_names, start=None, stop=None):
+    ''' Read the variables as an array (n, C, ...) with a single read if they are all stored in the same grouped dataset,
+        otherwise return None. '''
+    for node in f.root:
+        if not node._v_name.startswith('group_'):
+            continue
+        channels = node.title.split(',')
+        if all(v in channels for v in v_names):
+            indices = [channels.index(v) for v in v_names]
+            a = node[start:stop]
+            if indices != list(range(len(channels))):
+                a = a[:, indices]
+            return _widen(node, a, indices)
+    return None
+
+def _read_weight(f, wgt_vars, start=None, stop=None):
+    ''' Product of the weight columns; read the precomputed product (e.g., `total_weight`) if the file has one. '''
+    if len(wgt_vars) > 1:
+        for node in f.root:
+            if node.title == ','.join(wgt_vars):
+                return node[start:stop]
+    wgt = getattr(f.root, wgt_vars[0])[start:stop]
+    for w in wgt_vars[1:]:
+        wgt *= getattr(f.root, w)[start:stop]
+    return wgt
+
 def add_data_args(parser):
     data = parser.add_argument_group('Data', 'the input data')
     data.add_argument('--data-config', type=str, help='the python file for data format')
@@ -30,10 +291,11 @@ def add_data_args(parser):
     return data
 
 class DataFormat(object):
-    def __init__(self, train_groups, train_vars, label_var, wgtvar, obs_vars=[], extra_label_vars=[], sort_by=None, filename=None, plotting_mode=False):
+    def __init__(self, train_groups, train_vars, label_var, wgtvar, obs_vars=[], extra_label_vars=[], sort_by=None, filename=None, plotting_mode=False, image_pixels=None):
         self.train_groups = train_groups  # list
         self.train_vars = train_vars  # dict
         self.sort_by = sort_by  # dict {v_group:{'var':x, 'descend':False}}
+        self.image_pixels = image_pixels or {}  # dict {v_name:n_pixels}, resolution of the images stored as particles
         self.label_var = label_var
         self.wgtvar = wgtvar  # set to None if not using weights
         self.obs_vars = obs_vars  # list
@@ -54,6 +316,9 @@ class DataFormat(object):
 
     @staticmethod
     def nevts(filename, label_var='label'):
+        entry = _catalog_entry(filename)
+        if entry is not None and '/' + label_var in entry['datasets']:
+            return entry['datasets']['/' + label_var]['shape'][0]
         with tables.open_file(filename) as f:
 #             return getattr(f.root, f.root.__members__[0]).shape[0]
             return getattr(f.root, label_var).shape[0]
@@ -62,11 +327,17 @@ class DataFormat(object):
     def nwgtsum(filename, weight_vars='weight,class_weight'):
         wgt_vars = weight_vars.replace(' ', '').split(',')
         assert len(wgt_vars) > 0
+        entry = _catalog_entry(filename)
+        if entry is not None and ','.join(wgt_vars) in entry['weight_sums']:
+            return entry['weight_sums'][','.join(wgt_vars)]
         with tables.open_file(filename) as f:
-            return np.sum(np.prod([getattr(f.root, w) for w in wgt_vars], axis=0))
+            return np.sum(_read_weight(f, wgt_vars))
 
     @staticmethod
     def num_classes(filename, label_var='label'):
+        entry = _catalog_entry(filename)
+        if entry is not None and len(entry['datasets'].get('/' + label_var, {}).get('shape', [])) > 1:
+            return entry['datasets']['/' + label_var]['shape'][1]
         with tables.open_file(filename) as f:
             try:
                 return getattr(f.root, label_var).shape[1]
@@ -83,14 +354,14 @@ class DataFormat(object):
                 self.class_labels = [self.label_var]
             for v_group in self.train_groups:
                 n_channels = len(self.train_vars[v_group])
-                a = getattr(f.root, self.train_vars[v_group][0])
-                if a.ndim == 3:
+                shape = _var_shape(f, self.train_vars[v_group][0], self.image_pixels.get(self.train_vars[v_group][0]))
+                if len(shape) == 3:
                     # (n, W, H)
-                    width, height = a.shape[1:]
-                elif a.ndim == 2:
+                    width, height = shape[1:]
+                elif len(shape) == 2:
                     # (n, W)
-                    width, height = a.shape[1], 1
-                elif a.ndim == 1:
+                    width, height = shape[1], 1
+                elif len(shape) == 1:
                     # (n,)
                     width, height = 1, 1
                 else:
@@ -144,7 +415,13 @@ class PyTableEnqueuer(object):
             fbegin = 0
 
             with tables.open_file(self._filelist[ifile]) as f:
-                nevts = getattr(f.root, f.root.__members__[0]).shape[0]
+                nevts = getattr(f.root, self._data_format.label_var).shape[0]
+                clipped = {v_group: _is_clipped(f, self._data_format.train_vars[v_group], self._data_format.VAR_MIN, self._data_format.VAR_MAX)
+                           for v_group in self._data_format.train_groups}
+                # no need to sort the groups already sorted at conversion
+                presorted = {v_group: bool(self._data_format.sort_by and self._data_format.sort_by[v_group]) and
+                             _is_sorted(f, self._data_format.train_vars[v_group], self._data_format.sort_by[v_group])
+                             for v_group in self._data_format.train_groups}
 
                 while fbegin < nevts:
                     fend = fbegin + self._fetch_size
@@ -153,10 +430,29 @@ class PyTableEnqueuer(object):
                     # features
                     X_fetch = {}
                     for v_group in self._data_format.train_groups:
+                        shape = (-1,) + self._data_format.train_groups_shapes[v_group]  # (n, C, W, H), use -1 because end can go out of range
+                        sorting = self._data_format.sort_by and self._data_format.sort_by[v_group] and not presorted[v_group]
+                        if not sorting:
+                            # keep ragged groups and sparse images as they are until making the batches
+                            v_names = self._data_format.train_vars[v_group]
+                            x_rag = _read_ragged(f, v_names, fbegin, fend)
+                            if x_rag is None and len(v_names) == 1:
+                                x_rag = _read_image(f, v_names[0], fbegin, fend, self._data_format.image_pixels.get(v_names[0]))
+                            if x_rag is not None:
+                                if not clipped[v_group]:
+                                    x_rag.clip(self._data_format.VAR_MIN, self._data_format.VAR_MAX)
+                                x_rag.shape = shape
+                                X_fetch[v_group] = x_rag
+                                continue
                         # update variable ordering if needed
-                        if self._data_format.sort_by and self._data_format.sort_by[v_group]:
-                            ref_a = getattr(f.root, self._data_format.sort_by[v_group]['var'])[fbegin:fend]
-                            len_a = getattr(f.root, self._data_format.sort_by[v_group]['length_var'])[fbegin:fend]
+                        # read at once if the group is stored as a single dataset (n, C, W)
+                        x_arr = _read_group(f, self._data_format.train_vars[v_group], fbegin, fend)
+                        if x_arr is None and sorting:
+                            x_rag = _read_ragged(f, self._data_format.train_vars[v_group], fbegin, fend)
+                            x_arr = x_rag.dense() if x_rag is not None else None
+                        if sorting:
+                            ref_a = _read_var(f, self._data_format.sort_by[v_group]['var'], fbegin, fend)
+                            len_a = _read_var(f, self._data_format.sort_by[v_group]['length_var'], fbegin, fend)
                             for i in range(len_a.shape[0]):
                                 ref_a[i, int(len_a[i]):] = -np.inf if self._data_format.sort_by[v_group]['descend'] else np.inf
                             if ref_a.ndim != 2:
@@ -167,13 +463,19 @@ class PyTableEnqueuer(object):
                                 sorting_indices = np.argsort(-ref_a, axis=1)
                             else:
                                 sorting_indices = np.argsort(ref_a, axis=1)
-                            X_group = [getattr(f.root, v_name)[fbegin:fend][np.arange(ref_a.shape[0])[:, np.newaxis], sorting_indices]
-                                       for v_name in self._data_format.train_vars[v_group]]
-                        else:
-                            X_group = [getattr(f.root, v_name)[fbegin:fend] for v_name in self._data_format.train_vars[v_group]]
-                        
-                        shape = (-1,) + self._data_format.train_groups_shapes[v_group]  # (n, C, W, H), use -1 because end can go out of range
-                        if X_group[0].ndim == 3:
+                            if x_arr is not None:
+                                x_arr = x_arr[np.arange(ref_a.shape[0])[:, np.newaxis, np.newaxis], np.arange(x_arr.shape[1])[np.newaxis, :, np.newaxis],
+                                              sorting_indices[:, np.newaxis, :]]
+                            else:
+                                X_group = [_read_var(f, v_name, fbegin, fend)[np.arange(ref_a.shape[0])[:, np.newaxis], sorting_indices]
+                                           for v_name in self._data_format.train_vars[v_group]]
+                        elif x_arr is None:
+                            X_group = [_read_var(f, v_name, fbegin, fend) for v_name in self._data_format.train_vars[v_group]]
+
+                        if x_arr is not None:
+                            # shape=(n, C, W) or (n, C): already stacked
+                            pass
+                        elif X_group[0].ndim == 3:
                             # shape=(n, W, H): e.g., 2D image
                             assert len(X_group) == 1
                             x_arr = X_group[0]
@@ -185,7 +487,9 @@ class PyTableEnqueuer(object):
                             raise NotImplemented
     #                         if seq_order == 'channels_last':
     #                             x_arr = x_arr.transpose((0, 2, 1))
-                        X_fetch[v_group] = np.clip(x_arr, self._data_format.VAR_MIN, self._data_format.VAR_MAX).reshape(shape)
+                        if not clipped[v_group]:
+                            x_arr = np.clip(x_arr, self._data_format.VAR_MIN, self._data_format.VAR_MAX)
+                        X_fetch[v_group] = x_arr.reshape(shape)
 #                         logging.debug(' -- v_group=%s, fetch_array.shape=%s, reshape=%s' % (v_group, str(X_group[0].shape), str(shape)))
 
                     # labels
@@ -194,21 +498,18 @@ class PyTableEnqueuer(object):
                     # observers
                     Z_fetch = None
                     if self._predict_mode:
-                        Z_fetch = np.stack([getattr(f.root, v_name)[fbegin:fend] for v_name in self._data_format.obs_vars], axis=1)
+                        Z_fetch = np.stack([_read_var(f, v_name, fbegin, fend) for v_name in self._data_format.obs_vars], axis=1)
 
                     # extra labels
                     ext_fetch = None
                     if self._data_format.extra_label_vars:
-                        ext_fetch = np.stack([getattr(f.root, v_name)[fbegin:fend] for v_name in self._data_format.extra_label_vars], axis=1)
+                        ext_fetch = np.stack([_read_var(f, v_name, fbegin, fend) for v_name in self._data_format.extra_label_vars], axis=1)
 
                     # weights
                     W_fetch = None
                     if not self._predict_mode and self._data_format.wgtvar:
                         w_vars = self._data_format.wgtvar.replace(' ', '').split(',')
-                        wgt = getattr(f.root, w_vars[0])[fbegin:fend]
-                        for idx in range(1, len(w_vars)):
-                            wgt *= getattr(f.root, w_vars[idx])[fbegin:fend]
-                        W_fetch = wgt
+                        W_fetch = _read_weight(f, w_vars, fbegin, fend)
 
                     fbegin += self._fetch_size
                     
@@ -256,11 +557,13 @@ class PyTableEnqueuer(object):
 #                         delay = np.random.uniform() / 100
 #                         time.sleep(delay)
                         e = b + self._batch_size
-                        X_batch = {v_group:X_fetch[v_group][b:e] for v_group in X_fetch}
                         y_batch = y_fetch[b:e]
                         Z_batch = None if Z_fetch is None else Z_fetch[b:e]
                         ext_batch = None if ext_fetch is None else ext_fetch[b:e]
                         if len(y_batch) == self._batch_size:
+                            # pad the ragged groups and make the sparse images only now
+                            X_batch = {v_group: X_fetch[v_group][b:e].dense() if isinstance(X_fetch[v_group], (_RaggedFetch, _SparseImages)) else X_fetch[v_group][b:e]
+                                       for v_group in X_fetch}
                             self.queue.put((X_batch, y_batch, ext_batch, Z_batch))
         except Exception:
             # set stop flag if any exception occurs
@@ -34,6 +34,7 @@ obs_vars = [
     'orig_fjPuppi_tau21', 'orig_fjPuppi_tau32', 'orig_fjPuppi_corrsdmass',
     'orig_fj_sdsj1_csv', 'orig_fj_sdsj2_csv',
     ]
+image_pixels = {}  # {'img': n_pixels}: resolution for the images stored as particles (--image-format particles)
 
 def load_data(args):
 
@@ -43,7 +44,7 @@ def load_data(args):
     wgtvar = args.weight_names
     if wgtvar == '': wgtvar = None
 
-    d = DataFormat(train_groups, train_vars, label_var, wgtvar, obs_vars, filename=train_val_filelist[0])
+    d = DataFormat(train_groups, train_vars, label_var, wgtvar, obs_vars, filename=train_val_filelist[0], image_pixels=image_pixels)
 
     logging.info('Using the following variables:\n' +
                  '\n'.join([v_group + '\n\t' + str(train_vars[v_group]) for v_group in train_groups ]))